@@ -0,0 +1,39 @@
+"""run.pyの結果を2つ比較する
+
+    python benchmarks/compare.py before.json after.json
+"""
+import sys
+from pathlib import Path
+
+import orjson
+
+
+def _change(before, after) -> str:
+    if not before or after is None:
+        return "n/a"
+    return f"{(after - before) / before * 100:+.1f}%"
+
+
+def main(argv=None):
+    argv = argv if argv is not None else sys.argv[1:]
+    if len(argv) != 2:
+        print(__doc__, file=sys.stderr)
+        return 2
+    before, after = (orjson.loads(Path(path).read_bytes()) for path in argv)
+    previous = {r["scenario"]: r for r in before["results"]}
+    print(f"{before.get('commit')} -> {after.get('commit')}")
+    for result in after["results"]:
+        base = previous.get(result["scenario"])
+        if base is None:
+            continue
+        print(
+            f"{result['scenario']:<10} rps {_change(base['rps'], result['rps']):>8}  "
+            f"p50 {_change(base['latency_ms']['p50'], result['latency_ms']['p50']):>8}  "
+            f"p99 {_change(base['latency_ms']['p99'], result['latency_ms']['p99']):>8}  "
+            f"rss {_change(base['peak_rss_kb'], result['peak_rss_kb']):>8}"
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,80 @@
+# 実サイトを模したフィクスチャ。実際のページの構造(headのメタデータ、巨大なbody、SPAのインラインスクリプト)を再現している
+import zlib
+
+import orjson
+
+FILLER = (
+    "<p>Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt "
+    "ut labore et dolore magna aliqua. 日本語の本文も混ざっている記事を想定しています。</p>\n"
+)
+
+
+def _head(title: str, extra: str = "") -> str:
+    key = zlib.crc32(title.encode())
+    return f"""<head>
+<meta charset="utf-8">
+<title>{title} | Bench News</title>
+<meta property="og:title" content="{title}">
+<meta property="og:description" content="Description of {title}">
+<meta property="og:image" content="/images/{key % 1000}.jpg">
+<meta property="og:site_name" content="Bench News">
+<meta name="twitter:card" content="summary_large_image">
+<meta name="twitter:title" content="{title}">
+<link rel="icon" href="/favicon.ico">
+<link rel="alternate" type="application/activity+json" href="/ap/{key}">
+<meta name="fediverse:creator" content="@bench@news.bench.test">
+{extra}
+</head>"""
+
+
+def article(i: int, size: int = 600 * 1024) -> bytes:
+    # 大きなニュース記事: メタデータはheadにあり、bodyは数百KB
+    body = FILLER * (size // len(FILLER.encode()) + 1)
+    return f"<!DOCTYPE html><html lang='ja'>{_head(f'Article {i}')}<body><article>{body}</article></body></html>".encode()
+
+
+def spa(i: int, size: int = 400 * 1024) -> bytes:
+    # SPA: head内に巨大なインラインスクリプトとJSONがあり、</head>まで読んでも軽くならない
+    state = orjson.dumps({"items": [{"id": n, "name": f"item {n}", "tags": ["a", "b", "c"]} for n in range(size // 48)]}).decode()
+    scripts = f"<script>window.__INITIAL_STATE__={state}</script>" + "<script>function f(){return 1}</script>" * 200
+    return f"<!DOCTYPE html><html>{_head(f'App {i}', scripts)}<body><div id='root'></div></body></html>".encode()
+
+
+def video_page(i: int) -> bytes:
+    extra = f'<link rel="alternate" type="application/json+oembed" href="/oembed?id={i}">'
+    return f"<!DOCTYPE html><html>{_head(f'Video {i}', extra)}<body><div>player</div></body></html>".encode()
+
+
+def oembed(i: int) -> bytes:
+    return orjson.dumps(
+        {
+            "version": "1.0",
+            "type": "video",
+            "title": f"Video {i}",
+            "html": f'<iframe src="https://player.bench.test/embed/{i}" width="640" height="360" '
+            'allow="autoplay; encrypted-media; picture-in-picture" allowfullscreen></iframe>',
+        }
+    )
+
+
+def skeb_challenge() -> bytes:
+    return b'<html><head><script>document.cookie = "request_key=bench-key; path=/";location.reload();</script></head><body></body></html>'
+
+
+def skeb_work(i: int) -> bytes:
+    return f"<!DOCTYPE html><html>{_head(f'Skeb work {i}')}<body></body></html>".encode()
+
+
+def wikipedia_api(titles: str) -> bytes:
+    # formatversion=2のprop=extracts|pageimagesの応答を真似る
+    pages = [
+        {
+            "pageid": i,
+            "ns": 0,
+            "title": title,
+            "extract": f"{title} is a benchmark fixture. " * 40,
+            "thumbnail": {"source": f"https://upload.wikimedia.org/{i}.jpg", "width": 640, "height": 480},
+        }
+        for i, title in enumerate(titles.split("|"), 1)
+    ]
+    return orjson.dumps({"batchcomplete": True, "query": {"pages": pages}})
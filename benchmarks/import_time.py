@@ -0,0 +1,158 @@
+"""モジュールの読み込みにかかる時間とメモリを、毎回新しいプロセスで計測する
+
+    python benchmarks/import_time.py --runs 10 --output imports.json
+    python benchmarks/import_time.py --budget pysummaly=20 --budget pysummaly.server=600
+
+`import pysummaly`でaiohttp/lxml/FastAPIが読み込まれていたり、--budgetで指定したミリ秒を
+中央値が超えたりした場合は終了コード1を返すので、CIで後戻りを検出できる。
+パッケージ内のすべてのモジュールがそれぞれ単独で(新しいプロセスで最初に)読み込めるかも確認する
+"""
+import argparse
+import importlib.util
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+import orjson
+
+TARGETS = ("pysummaly", "pysummaly.summaly", "pysummaly.server")
+HEAVY = ("aiohttp", "lxml", "fastapi", "pydantic", "redis")
+# 読み込んだだけでは重い依存を引き込んではいけないモジュール
+LIGHT = {"pysummaly": HEAVY}
+
+PROBE = """
+import resource, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+heavy = [name for name in {heavy!r} if name in sys.modules]
+import json
+print(json.dumps({{"ms": elapsed * 1000, "rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, "heavy": heavy}}))
+"""
+
+
+def probe(module: str) -> dict:
+    output = subprocess.run(
+        [sys.executable, "-c", PROBE.format(module=module, heavy=HEAVY)],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return orjson.loads(output)
+
+
+def slowest(module: str, count: int = 10) -> list[dict]:
+    # -X importtimeの累積時間が大きいものから
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"], capture_output=True, text=True, check=True
+    ).stderr
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        rows.append({"module": name.strip(), "cumulative_ms": int(cumulative) / 1000})
+    return sorted(rows, key=lambda row: row["cumulative_ms"], reverse=True)[:count]
+
+
+def submodules(package: str = "pysummaly") -> list[str]:
+    # パッケージ自体は読み込まずに、ファイルの一覧からモジュール名を作る
+    root = Path(importlib.util.find_spec(package).submodule_search_locations[0])
+    names = []
+    for path in sorted(root.rglob("*.py")):
+        parts = path.relative_to(root).with_suffix("").parts
+        if parts[-1] == "__init__":
+            parts = parts[:-1]
+        if parts[-1:] != ("__main__",):
+            names.append(".".join((package, *parts)))
+    return names
+
+
+def check_imports(modules: list[str]) -> list[str]:
+    # 循環importはどのモジュールから読み込み始めたかで出たり出なかったりするので、1つずつ別のプロセスで試す
+    failures = []
+    for module in modules:
+        result = subprocess.run([sys.executable, "-c", f"import {module}"], capture_output=True, text=True)
+        if result.returncode != 0:
+            lines = result.stderr.strip().splitlines()
+            failures.append(f"{module}: {lines[-1] if lines else result.returncode}")
+    return failures
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--module", action="append", help=f"default: {', '.join(TARGETS)}")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget", action="append", default=[], metavar="MODULE=MS")
+    parser.add_argument("--skip-submodules", action="store_true", help="do not check that every module imports on its own")
+    parser.add_argument("--output", help="write JSON results to this file (default: stdout)")
+    args = parser.parse_args(argv)
+    budgets = {module: float(ms) for module, ms in (item.split("=", 1) for item in args.budget)}
+
+    results = []
+    failed = False
+    for module in args.module or TARGETS:
+        samples = [probe(module) for _ in range(args.runs)]
+        times = [sample["ms"] for sample in samples]
+        heavy = samples[0]["heavy"]
+        result = {
+            "module": module,
+            "import_ms": {
+                "median": round(statistics.median(times), 3),
+                "min": round(min(times), 3),
+                "max": round(max(times), 3),
+            },
+            "peak_rss_kb": max(sample["rss_kb"] for sample in samples),
+            "heavy_modules": heavy,
+            "slowest": slowest(module),
+        }
+        results.append(result)
+
+        problems = []
+        unexpected = [name for name in heavy if name in LIGHT.get(module, ())]
+        if unexpected:
+            problems.append(f"imports {', '.join(unexpected)}")
+        budget = budgets.get(module)
+        if budget is not None and result["import_ms"]["median"] > budget:
+            problems.append(f"over budget ({budget} ms)")
+        failed = failed or bool(problems)
+        print(
+            f"{module:<20} {result['import_ms']['median']:>9} ms  rss {result['peak_rss_kb']:>8} kB"
+            + (f"  FAIL: {'; '.join(problems)}" if problems else ""),
+            file=sys.stderr,
+        )
+
+    import_failures = [] if args.skip_submodules else check_imports(submodules())
+    for failure in import_failures:
+        print(f"FAIL: cannot import {failure}", file=sys.stderr)
+    failed = failed or bool(import_failures)
+
+    report = orjson.dumps(
+        {
+            "commit": git_commit(),
+            "python": sys.version.split()[0],
+            "runs": args.runs,
+            "results": results,
+            "import_failures": import_failures,
+        },
+        option=orjson.OPT_INDENT_2,
+    )
+    if args.output:
+        Path(args.output).write_bytes(report)
+    else:
+        sys.stdout.buffer.write(report + b"\n")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,122 @@
+# ベンチマーク用のローカルオリジン。すべてのホスト名をこのサーバーに向けて使う
+import asyncio
+import multiprocessing
+import socket
+import time
+
+from aiohttp import web
+
+import fixtures
+
+CHUNKED_DELAY = 0.02
+
+
+def _html(body: bytes) -> web.Response:
+    return web.Response(body=body, content_type="text/html", charset="utf-8")
+
+
+async def article(request: web.Request):
+    return _html(fixtures.article(int(request.match_info["i"])))
+
+
+async def spa(request: web.Request):
+    return _html(fixtures.spa(int(request.match_info["i"])))
+
+
+async def video(request: web.Request):
+    return _html(fixtures.video_page(int(request.match_info["i"])))
+
+
+async def youtube_watch(request: web.Request):
+    return _html(fixtures.video_page(int(request.query.get("v", "0"))))
+
+
+async def oembed(request: web.Request):
+    i = request.query.get("id") or request.query.get("url", "0").rsplit("=", 1)[-1]
+    return web.Response(body=fixtures.oembed(int(i)), content_type="application/json")
+
+
+async def chunked(request: web.Request):
+    # Content-Lengthなしで少しずつ返す遅いサーバー
+    body = fixtures.article(int(request.match_info["i"]))
+    response = web.StreamResponse()
+    response.content_type = "text/html"
+    await response.prepare(request)
+    try:
+        for start in range(0, len(body), 16 * 1024):
+            await response.write(body[start:start + 16 * 1024])
+            await asyncio.sleep(CHUNKED_DELAY)
+        await response.write_eof()
+    except ConnectionError:
+        # </head>まで読んだクライアントは途中で切断する
+        pass
+    return response
+
+
+async def skeb(request: web.Request):
+    # Skebと同じくRetry-After: 0の429を返し、cookieのrequest_keyがあれば本文を返す
+    if request.cookies.get("request_key") != "bench-key":
+        return web.Response(
+            status=429,
+            body=fixtures.skeb_challenge(),
+            content_type="text/html",
+            headers={"Retry-After": "0"},
+        )
+    return _html(fixtures.skeb_work(int(request.match_info["i"])))
+
+
+async def wikipedia_api(request: web.Request):
+    return web.Response(body=fixtures.wikipedia_api(request.query.get("titles", "")), content_type="application/json")
+
+
+async def favicon(request: web.Request):
+    return web.Response(body=b"\x00" * 1024, content_type="image/x-icon")
+
+
+def create_app() -> web.Application:
+    app = web.Application()
+    app.router.add_get("/article/{i}", article)
+    app.router.add_get("/app/{i}", spa)
+    app.router.add_get("/video/{i}", video)
+    app.router.add_get("/watch", youtube_watch)
+    app.router.add_get("/oembed", oembed)
+    app.router.add_get("/chunked/{i}", chunked)
+    app.router.add_get("/@bench/works/{i}", skeb)
+    app.router.add_get("/w/api.php", wikipedia_api)
+    app.router.add_get("/favicon.ico", favicon)
+    return app
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _serve(port: int):
+    web.run_app(create_app(), host="127.0.0.1", port=port, print=None, access_log=None)
+
+
+def start(port: int = 0) -> tuple[multiprocessing.Process, int]:
+    # 計測対象と同じイベントループ・同じプロセスで動かさないよう別プロセスで起動する
+    port = port or free_port()
+    process = multiprocessing.Process(target=_serve, args=(port,), daemon=True)
+    process.start()
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+                return process, port
+        except OSError:
+            time.sleep(0.05)
+    process.terminate()
+    raise RuntimeError("fixture origin did not start")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serve benchmark fixtures")
+    parser.add_argument("--port", type=int, default=8080)
+    args = parser.parse_args()
+    _serve(args.port)
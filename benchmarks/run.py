@@ -0,0 +1,217 @@
+"""summarize()とserver.pyのアプリをローカルのフィクスチャオリジンに対して計測する
+
+    python benchmarks/run.py --concurrency 32 --requests 300 --output result.json
+    python benchmarks/run.py --target server --scenario article --scenario spa
+
+結果はJSONで出力されるので、コミット間の比較には compare.py を使う
+"""
+import argparse
+import asyncio
+import ipaddress
+import platform
+import resource
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import orjson
+from aiohttp.abc import AbstractResolver
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import origin  # noqa: E402
+
+from pysummaly import Summarizer, metrics  # noqa: E402
+from pysummaly.plugins import wikipedia, youtube  # noqa: E402
+from pysummaly.scheduler import HostScheduler  # noqa: E402
+
+LOOPBACK = (ipaddress.ip_network("127.0.0.0/8"),)
+
+SCENARIOS = {
+    "article": "http://news.bench.test:{port}/article/{i}",
+    "spa": "http://spa.bench.test:{port}/app/{i}",
+    "oembed": "http://video.bench.test:{port}/video/{i}",
+    "chunked": "http://slow.bench.test:{port}/chunked/{i}",
+    "skeb": "http://skeb.jp:{port}/@bench/works/{i}",
+    "wikipedia": "http://en.wikipedia.org:{port}/wiki/Benchmark_{i}",
+    "youtube": "http://www.youtube.com:{port}/watch?v={i}",
+}
+
+
+class LoopbackResolver(AbstractResolver):
+    """どのホスト名もフィクスチャオリジン(127.0.0.1)に解決する"""
+
+    async def resolve(self, host, port=0, family=socket.AF_INET):
+        return [
+            {
+                "hostname": host,
+                "host": "127.0.0.1",
+                "port": port,
+                "family": socket.AF_INET,
+                "proto": 0,
+                "flags": socket.AI_NUMERICHOST,
+            }
+        ]
+
+    async def close(self):
+        pass
+
+
+def percentile(values: list[float], p: float) -> float | None:
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))
+    return values[index]
+
+
+def stage_snapshot() -> dict:
+    return {key[0]: value for key, value in metrics.stage_seconds.totals().items()}
+
+
+def stage_delta(before: dict, after: dict) -> dict:
+    stages = {}
+    for stage, (count, total) in after.items():
+        count -= before.get(stage, (0, 0.0))[0]
+        total -= before.get(stage, (0, 0.0))[1]
+        if count:
+            stages[stage] = {"count": count, "mean_ms": round(total / count * 1000, 3)}
+    return stages
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def drive(call, urls: list[str], concurrency: int) -> tuple[list[float], int, float]:
+    limit = asyncio.Semaphore(concurrency)
+    latencies: list[float] = []
+    errors = 0
+
+    async def one(url):
+        nonlocal errors
+        async with limit:
+            start = time.perf_counter()
+            try:
+                ok = await call(url)
+            except Exception:
+                ok = False
+            latencies.append(time.perf_counter() - start)
+            if not ok:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(url) for url in urls))
+    return latencies, errors, time.perf_counter() - start
+
+
+def summarizer(rate: float | None, **kwargs) -> Summarizer:
+    # 全シナリオが1つのオリジンに集中するので、流量制御は--rateで指定したときだけ有効にする
+    return Summarizer(
+        resolver=LoopbackResolver(),
+        allow_networks=LOOPBACK,
+        scheduler=HostScheduler(rate=rate, concurrency=1000),
+        **kwargs,
+    )
+
+
+async def run_library(urls: list[str], concurrency: int, rate: float | None):
+    async with summarizer(rate) as s:
+
+        async def call(url):
+            return bool(await s.summarize(url))
+
+        return await drive(call, urls, concurrency)
+
+
+async def run_server(urls: list[str], concurrency: int, rate: float | None):
+    import httpx
+
+    from pysummaly.server import app, create_cache
+
+    async with app.router.lifespan_context(app):
+        async with summarizer(rate, cache=create_cache()) as s:
+            app.state.summarizer = s
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+
+                async def call(url):
+                    response = await client.get("/url", params={"url": url})
+                    return response.status_code == 200
+
+                return await drive(call, urls, concurrency)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--target", choices=("library", "server"), default="library")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS), help="default: all")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario")
+    parser.add_argument("--distinct", type=int, default=0, help="number of distinct URLs (default: all distinct)")
+    parser.add_argument("--rate", type=float, default=None, help="per-host requests/sec (default: unlimited)")
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--output", help="write JSON results to this file (default: stdout)")
+    args = parser.parse_args(argv)
+
+    process, port = origin.start(args.port)
+    # ハードコードされたAPIの向き先をフィクスチャオリジンに差し替える
+    wikipedia.API_ENDPOINT = f"http://{{lang}}.wikipedia.org:{port}/w/api.php"
+    youtube.OEMBED_ENDPOINT = f"http://www.youtube.com:{port}/oembed"
+
+    runner = run_library if args.target == "library" else run_server
+    distinct = args.distinct or args.requests
+    results = []
+    try:
+        for name in args.scenario or sorted(SCENARIOS):
+            urls = [SCENARIOS[name].format(port=port, i=i % distinct) for i in range(args.requests)]
+            before = stage_snapshot()
+            latencies, errors, elapsed = asyncio.run(runner(urls, args.concurrency, args.rate))
+            result = {
+                "scenario": name,
+                "requests": len(urls),
+                "errors": errors,
+                "seconds": round(elapsed, 3),
+                "rps": round(len(urls) / elapsed, 2) if elapsed else None,
+                "latency_ms": {
+                    f"p{p}": round(percentile(latencies, p) * 1000, 3) for p in (50, 90, 99)
+                }
+                | {"max": round(max(latencies) * 1000, 3)},
+                "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                "stages": stage_delta(before, stage_snapshot()),
+            }
+            results.append(result)
+            print(
+                f"{name:<10} {result['rps']:>9} req/s  p50 {result['latency_ms']['p50']:>9} ms  "
+                f"p99 {result['latency_ms']['p99']:>9} ms  errors {errors}",
+                file=sys.stderr,
+            )
+    finally:
+        process.terminate()
+        process.join()
+
+    report = orjson.dumps(
+        {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "target": args.target,
+            "concurrency": args.concurrency,
+            "results": results,
+        },
+        option=orjson.OPT_INDENT_2,
+    )
+    if args.output:
+        Path(args.output).write_bytes(report)
+    else:
+        sys.stdout.buffer.write(report + b"\n")
+
+
+if __name__ == "__main__":
+    main()
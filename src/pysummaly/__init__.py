@@ -1,5 +1,51 @@
-from importlib.metadata import version
+# aiohttpやlxmlの読み込みには時間がかかるので、実際に使われるまで読み込まない
+import importlib
 
-from .summaly import *
+# 名前 → 定義しているモジュール。以前 from .summaly import * で見えていた名前も含む
+_LAZY = {
+    "ICON_BUDGET_RATIO": "summaly",
+    "PLAYER_BUDGET_RATIO": "summaly",
+    "DEFAULT_USER_AGENT": "summaly",
+    "favicon_cache": "summaly",
+    "oembed_cache": "summaly",
+    "fetch_document": "summaly",
+    "fetch": "summaly",
+    "fetch_head": "summaly",
+    "escape_html_in_json": "summaly",
+    "get_oembed_player": "summaly",
+    "fetch_oembed_player": "summaly",
+    "fetch_tree": "summaly",
+    "with_budget": "summaly",
+    "summarize": "summaly",
+    "summarize_many": "summaly",
+    "summarize_with_session": "summaly",
+    "Summarizer": "summaly",
+    "request_key": "summaly",
+    "Summary": "result",
+    "Player": "result",
+    "SummaryCache": "cache",
+    "Canonicalizer": "canonical",
+    "canonicalize": "canonical",
+    "HostScheduler": "scheduler",
+    "HostHealth": "health",
+}
 
-__version__ = version("pysummaly")
+__all__ = list(_LAZY)
+
+
+def __getattr__(name: str):
+    if name == "__version__":
+        from importlib.metadata import version
+
+        globals()["__version__"] = value = version("pysummaly")
+        return value
+    # それ以外の名前はAttributeErrorにして、from . import metrics などが通常のサブモジュールの読み込みになるようにする
+    if name not in _LAZY:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(f".{_LAZY[name]}", __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY) | {"__version__"})
@@ -0,0 +1,368 @@
+import asyncio
+import sqlite3
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from collections.abc import Awaitable, Callable
+from typing import Any, Protocol
+
+import orjson
+
+from . import metrics
+from .fetcher import NotModified, Validators, revalidation
+from .result import Summary
+
+MISSING = object()
+NULL = b"null"
+# SummaryCacheのエントリのメタデータのうち、条件付きリクエストと304後の期限に使うもの
+VALIDATOR_FIELDS = ("etag", "last_modified", "max_age")
+
+
+class CachedError(Exception):
+    """ネガティブキャッシュに載っている失敗を返すときに使う"""
+
+
+class CacheBackend(Protocol):
+    async def get(self, key: str) -> bytes | None: ...
+
+    async def set(self, key: str, value: bytes, ttl: float) -> None: ...
+
+    async def delete(self, key: str) -> None: ...
+
+
+class TTLCache:
+    """サイズ上限付きのLRU+TTLキャッシュ(同期版)"""
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict[Any, tuple[float, Any]] = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, MISSING) is not MISSING
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            return default
+        expires, value = item
+        if expires < time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl: float | None = None):
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def clear(self):
+        self._data.clear()
+
+
+class MemoryBackend:
+    """プロセス内のLRU+TTLキャッシュ"""
+
+    def __init__(self, maxsize: int = 10000):
+        self._data = TTLCache(maxsize)
+
+    def __len__(self):
+        return len(self._data)
+
+    async def get(self, key: str) -> bytes | None:
+        return self._data.get(key)
+
+    async def set(self, key: str, value: bytes, ttl: float) -> None:
+        self._data.set(key, value, ttl)
+
+    async def delete(self, key: str) -> None:
+        self._data.pop(key)
+
+
+class RedisBackend:
+    """redis.asyncio互換のクライアント(get/set(ex=)/delete)を使う共有キャッシュ"""
+
+    def __init__(self, client, prefix: str = "pysummaly:"):
+        self.client = client
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url: str, **kwargs):
+        try:
+            from redis import asyncio as aioredis
+        except ImportError as e:
+            raise ImportError("RedisBackend requires the 'redis' package (pip install pysummaly[redis])") from e
+        return cls(aioredis.from_url(url), **kwargs)
+
+    async def get(self, key: str) -> bytes | None:
+        return await self.client.get(self.prefix + key)
+
+    async def set(self, key: str, value: bytes, ttl: float) -> None:
+        await self.client.set(self.prefix + key, value, ex=max(1, int(ttl)))
+
+    async def delete(self, key: str) -> None:
+        await self.client.delete(self.prefix + key)
+
+
+class SQLiteBackend:
+    """SQLiteのファイルに保存する永続キャッシュ。再起動後も残り、同じホストのワーカー間で共有できる
+
+    合計サイズがmax_bytesを超えたら、最近使われていないものから消す。
+    """
+
+    # 最終アクセス時刻の更新はこの秒数に1回まで(読み込みのたびに書き込まないため)
+    ACCESS_RESOLUTION = 60
+    # この回数の書き込みごとに期限切れを消し、合計サイズを数え直す(他のプロセスの書き込みも反映する)
+    SYNC_INTERVAL = 256
+
+    def __init__(self, path: str, max_bytes: int = 256 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        # sqlite3は同期APIなので、1本のスレッドに順番に実行させる
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pysummaly-sqlite")
+        self._db: sqlite3.Connection | None = None
+        self._size = 0
+        self._writes = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            db = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS summaries ("
+                "key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS summaries_accessed ON summaries (accessed)")
+            self._db = db
+            self._sync()
+        return self._db
+
+    def _sync(self):
+        self._db.execute("DELETE FROM summaries WHERE expires < ?", (time.time(),))
+        self._size = self._db.execute("SELECT COALESCE(SUM(LENGTH(value)), 0) FROM summaries").fetchone()[0]
+
+    def _get(self, key: str) -> bytes | None:
+        db = self._connect()
+        row = db.execute("SELECT value, expires, accessed FROM summaries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        value, expires, accessed = row
+        now = time.time()
+        if expires < now:
+            db.execute("DELETE FROM summaries WHERE key = ?", (key,))
+            return None
+        if now - accessed > self.ACCESS_RESOLUTION:
+            db.execute("UPDATE summaries SET accessed = ? WHERE key = ?", (now, key))
+        return value
+
+    def _set(self, key: str, value: bytes, ttl: float):
+        db = self._connect()
+        now = time.time()
+        db.execute(
+            "INSERT OR REPLACE INTO summaries (key, value, expires, accessed) VALUES (?, ?, ?, ?)",
+            (key, value, now + ttl, now),
+        )
+        self._size += len(value)
+        self._writes += 1
+        if self._writes % self.SYNC_INTERVAL == 0:
+            self._sync()
+        if self._size > self.max_bytes:
+            self._evict()
+
+    def _evict(self):
+        # 上限の9割まで減らしておき、毎回の書き込みで消すことにならないようにする
+        excess = self._size - self.max_bytes * 0.9
+        keys = []
+        for key, size in self._db.execute("SELECT key, LENGTH(value) FROM summaries ORDER BY accessed"):
+            if excess <= 0:
+                break
+            keys.append((key,))
+            excess -= size
+        self._db.executemany("DELETE FROM summaries WHERE key = ?", keys)
+        self._sync()
+
+    def _delete(self, key: str):
+        self._connect().execute("DELETE FROM summaries WHERE key = ?", (key,))
+
+    def _close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    async def get(self, key: str) -> bytes | None:
+        return await self._run(self._get, key)
+
+    async def set(self, key: str, value: bytes, ttl: float) -> None:
+        await self._run(self._set, key, value, ttl)
+
+    async def delete(self, key: str) -> None:
+        await self._run(self._delete, key)
+
+    async def close(self) -> None:
+        await self._run(self._close)
+        self._executor.shutdown()
+
+
+class SummaryCache:
+    """要約のキャッシュ。期限はオリジンのCache-Controlに従い、期限切れ後はETag/Last-Modifiedで取り直す"""
+
+    def __init__(
+        self,
+        backend: CacheBackend | None = None,
+        ttl: float = 600,
+        negative_ttl: float = 60,
+        stale_ttl: float = 300,
+        min_ttl: float = 60,
+        max_ttl: float = 24 * 60 * 60,
+        revalidate_ttl: float = 24 * 60 * 60,
+    ):
+        self.backend = backend if backend is not None else MemoryBackend()
+        # ttlはオリジンが有効期間を示さなかったときの値。示された場合はmin_ttl〜max_ttlに収める
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.stale_ttl = stale_ttl
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        # 検証子がある要約は、古い値を返す猶予を過ぎてもこの間は条件付きリクエストのために残す
+        self.revalidate_ttl = revalidate_ttl
+        self._refreshing: dict[str, asyncio.Task] = {}
+
+    async def close(self):
+        # 永続化するバックエンドはファイルや接続を閉じる
+        close = getattr(self.backend, "close", None)
+        if close is not None:
+            await close()
+
+    async def get_or_fetch(self, key: str, fetch: Callable[[], Awaitable[Summary | None]]) -> Summary | None:
+        value, _ = await self.get_or_fetch_with_max_age(key, fetch)
+        return value
+
+    async def get_or_fetch_with_max_age(
+        self, key: str, fetch: Callable[[], Awaitable[Summary | None]]
+    ) -> tuple[Summary | None, float]:
+        # 値と、それがあと何秒新しいかを返す
+        raw = await self.backend.get(key)
+        entry = self._decode(raw) if raw is not None else None
+        if entry is None:
+            metrics.cache_requests.inc(cache="summary", result="miss")
+            return await self._refresh(key, fetch)
+        meta, _ = entry
+        now = time.time()
+        if now < meta["fresh_until"]:
+            metrics.cache_requests.inc(cache="summary", result="hit")
+            return self._unpack(entry), meta["fresh_until"] - now
+        if now < meta["stale_until"]:
+            metrics.cache_requests.inc(cache="summary", result="stale")
+            if key not in self._refreshing:
+                # 期限切れでも猶予期間内なら古い値を返し、裏で取り直す
+                task = asyncio.ensure_future(self._refresh(key, fetch, entry, background=True))
+                self._refreshing[key] = task
+                task.add_done_callback(lambda t: self._refreshed(key, t))
+            return self._unpack(entry), 0.0
+        # 猶予も過ぎたが検証子が残っている。変わっていなければ304だけで済む
+        metrics.cache_requests.inc(cache="summary", result="revalidate")
+        return await self._refresh(key, fetch, entry)
+
+    def _refreshed(self, key: str, task: asyncio.Task):
+        self._refreshing.pop(key, None)
+        if not task.cancelled():
+            task.exception()
+
+    async def _refresh(
+        self,
+        key: str,
+        fetch: Callable[[], Awaitable[Summary | None]],
+        entry: tuple[dict, bytes] | None = None,
+        background: bool = False,
+    ) -> tuple[Summary | None, float]:
+        validators = Validators()
+        if entry is not None and entry[1] not in (b"", NULL):
+            validators.etag = entry[0].get("etag")
+            validators.last_modified = entry[0].get("last_modified")
+            # 304がCache-Controlを付けてこなければ、前回オリジンが示した有効期間を使う
+            validators.max_age = entry[0].get("max_age")
+        token = revalidation.set(validators)
+        try:
+            value = await fetch()
+        except NotModified:
+            metrics.cache_requests.inc(cache="summary", result="not_modified")
+            ttl = self._ttl(validators.max_age)
+            await self._store(key, self._meta(validators), entry[1], ttl)
+            return self._unpack(entry), ttl
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # 裏での取り直しに失敗した場合は古い値を残しておく
+            if background:
+                raise
+            if entry is not None and entry[1] not in (b"", NULL):
+                # 猶予を過ぎていても、一時的な失敗(キュー待ち・ブレーカー・タイムアウトなど)で要約を捨てず、
+                # 検証子ごと残してそれを返す(stale-if-error)。しばらくは取り直さない
+                metrics.cache_requests.inc(cache="summary", result="stale_if_error")
+                meta = {name: entry[0][name] for name in VALIDATOR_FIELDS if name in entry[0]}
+                await self._store(key, meta, entry[1], self.negative_ttl, stale=False)
+                return self._unpack(entry), 0.0
+            await self._store(key, {"error": str(e)}, b"", self.negative_ttl, stale=False)
+            raise
+        finally:
+            revalidation.reset(token)
+        if value is None:
+            await self._store(key, {}, NULL, self.negative_ttl, stale=False)
+            return value, self.negative_ttl
+        ttl = self._ttl(validators.max_age)
+        await self._store(key, self._meta(validators), value.json, ttl)
+        return value, ttl
+
+    def _ttl(self, max_age: float | None) -> float:
+        if max_age is None:
+            return self.ttl
+        return min(max(max_age, self.min_ttl), self.max_ttl)
+
+    @staticmethod
+    def _meta(validators: Validators) -> dict:
+        meta = {}
+        if validators.etag:
+            meta["etag"] = validators.etag
+        if validators.last_modified:
+            meta["last_modified"] = validators.last_modified
+        if validators.max_age is not None and meta:
+            meta["max_age"] = validators.max_age
+        return meta
+
+    async def _store(self, key: str, meta: dict, payload: bytes, ttl: float, stale: bool = True):
+        # 期限などの小さなJSONの後に、要約のJSONをバイト列のまま続ける
+        now = time.time()
+        stale_ttl = self.stale_ttl if stale else 0
+        meta["fresh_until"] = now + ttl
+        meta["stale_until"] = now + ttl + stale_ttl
+        keep = self.revalidate_ttl if "etag" in meta or "last_modified" in meta else 0
+        await self.backend.set(key, orjson.dumps(meta) + b"\n" + payload, ttl + max(stale_ttl, keep))
+
+    @staticmethod
+    def _decode(raw: bytes) -> tuple[dict, bytes] | None:
+        meta, sep, payload = raw.partition(b"\n")
+        if not sep:
+            # 以前の形式のエントリは取り直す
+            return None
+        return orjson.loads(meta), payload
+
+    @staticmethod
+    def _unpack(entry: tuple[dict, bytes]) -> Summary | None:
+        meta, payload = entry
+        if "error" in meta:
+            raise CachedError(meta["error"])
+        # 要約はパースせず、JSONのバイト列のまま持たせる
+        return None if payload == NULL else Summary.from_json(payload)
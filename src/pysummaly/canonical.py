@@ -0,0 +1,102 @@
+# キャッシュやリクエストの集約に使うURLの正規化
+# 同じページを指すURL(ホストの大文字小文字・既定のポート・フラグメント・トラッキング用パラメータ・短縮URL)を1つにまとめる
+import os
+from collections.abc import Callable, Iterable
+from urllib.parse import unquote
+
+import yarl
+
+# どのサイトでもページの内容を変えないパラメータ
+TRACKING_PARAMS = frozenset({
+    "fbclid", "gclid", "dclid", "gbraid", "wbraid", "msclkid", "yclid", "twclid", "ttclid",
+    "igshid", "mc_cid", "mc_eid", "_hsenc", "_hsmi", "mkt_tok", "_ga", "_gl",
+    "oly_anon_id", "oly_enc_id", "vero_id", "rb_clickid", "s_cid",
+    "_branch_match_id", "_branch_referrer",
+})
+TRACKING_PREFIXES = ("utm_",)
+
+# 特定のサイトでだけ共有元の追跡に使われるパラメータ
+HOST_TRACKING_PARAMS = {
+    "www.youtube.com": frozenset({"si", "feature", "pp"}),
+    "open.spotify.com": frozenset({"si", "context"}),
+}
+
+
+def _youtu_be(url: yarl.URL) -> yarl.URL:
+    video_id = url.path.strip("/")
+    if not video_id or "/" in video_id:
+        return url
+    # 再生位置(t)などはそのまま引き継ぐ
+    query = [("v", video_id), *((k, v) for k, v in url.query.items() if k != "v")]
+    return url.with_host("www.youtube.com").with_path("/watch").with_query(query)
+
+
+def _www_youtube(url: yarl.URL) -> yarl.URL:
+    return url.with_host("www.youtube.com")
+
+
+# 短縮URLや別名のホストから、正規のURLへの書き換え
+ALIASES: dict[str, Callable[[yarl.URL], yarl.URL]] = {
+    "youtu.be": _youtu_be,
+    "youtube.com": _www_youtube,
+    "m.youtube.com": _www_youtube,
+}
+
+
+class Canonicalizer:
+    def __init__(
+        self,
+        tracking_params: Iterable[str] = TRACKING_PARAMS,
+        tracking_prefixes: Iterable[str] = TRACKING_PREFIXES,
+        host_tracking_params: dict[str, Iterable[str]] = HOST_TRACKING_PARAMS,
+        aliases: dict[str, Callable[[yarl.URL], yarl.URL]] = ALIASES,
+    ):
+        self.tracking_params = frozenset(tracking_params)
+        self.tracking_prefixes = tuple(tracking_prefixes)
+        self.host_tracking_params = {host: frozenset(params) for host, params in host_tracking_params.items()}
+        self.aliases = dict(aliases)
+
+    def is_tracking(self, name: str, host: str) -> bool:
+        return (
+            name in self.tracking_params
+            or name.startswith(self.tracking_prefixes)
+            or name in self.host_tracking_params.get(host, ())
+        )
+
+    def __call__(self, url: str) -> str:
+        parsed = yarl.URL(url)
+        if not parsed.absolute or not parsed.host:
+            return url
+        # yarlがホストの小文字化と既定のポートの省略を行う
+        parsed = parsed.with_fragment(None)
+        host = parsed.host.rstrip(".")
+        if host != parsed.host:
+            parsed = parsed.with_host(host)
+        alias = self.aliases.get(host)
+        if alias is not None:
+            parsed = alias(parsed)
+            host = parsed.host
+
+        # 値のエンコードを変えないよう、生のクエリ文字列のまま取り除く
+        raw_query = parsed.raw_query_string
+        # yarlは空のパスもraw_path == "/"と返すが、文字列には"/"を付けないので補う(with_pathはクエリを消す)
+        if parsed.raw_path == "/" and not str(parsed.with_query(None)).endswith("/"):
+            parsed = parsed.with_path("/")
+        if not raw_query:
+            return str(parsed)
+        parts = [
+            part for part in raw_query.split("&")
+            if part and not self.is_tracking(unquote(part.partition("=")[0]), host)
+        ]
+        base = str(parsed.with_query(None))
+        return f"{base}?{'&'.join(parts)}" if parts else base
+
+
+canonicalize = Canonicalizer()
+
+
+def create_canonicalizer() -> Canonicalizer:
+    # STRIP_QUERY_PARAMSにカンマ区切りで指定したパラメータも、キャッシュのキーと取得先のURLから取り除く
+    # サーバーと事前取得(warm)で同じキーになるよう、どちらもこれを使う
+    extra = [name.strip() for name in os.environ.get("STRIP_QUERY_PARAMS", "").split(",") if name.strip()]
+    return Canonicalizer(tracking_params=TRACKING_PARAMS | set(extra))
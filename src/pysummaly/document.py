@@ -0,0 +1,121 @@
+import asyncio
+import codecs
+import re
+import threading
+from concurrent.futures import Executor
+
+from lxml import html as lxml_html
+
+from . import metrics
+from .extract import extract_metadata
+
+# <meta charset>や<meta http-equiv content="...; charset=...">は先頭付近にあるはず
+SNIFF_SIZE = 4096
+META_CHARSET = re.compile(rb"""<meta[^>]+charset\s*=\s*["']?\s*([a-zA-Z0-9_.:-]+)""", re.IGNORECASE)
+BOMS = (
+    (codecs.BOM_UTF8, "utf-8"),
+    (codecs.BOM_UTF16_LE, "utf-16-le"),
+    (codecs.BOM_UTF16_BE, "utf-16-be"),
+)
+
+# これより大きいページは、executorが指定されていればイベントループの外でパースする
+OFFLOAD_THRESHOLD = 256 * 1024
+
+# HTMLParserはスレッド間で共有できないので、スレッドごとに持つ
+_local = threading.local()
+
+
+def _lookup(label: str | None) -> str | None:
+    if not label:
+        return None
+    try:
+        # lxml(libxml2)はeuc_jpのようなPythonの綴りを知らないのでeuc-jpに寄せる
+        return codecs.lookup(label.strip()).name.replace("_", "-")
+    except LookupError:
+        return None
+
+
+def _decodes(body: bytes, encoding: str) -> bool:
+    try:
+        codecs.getincrementaldecoder(encoding)().decode(body[: SNIFF_SIZE * 16], final=False)
+    except UnicodeDecodeError:
+        return False
+    return True
+
+
+def detect_encoding(body: bytes, declared: str | None = None) -> str:
+    for bom, encoding in BOMS:
+        if body.startswith(bom):
+            return encoding
+    # 非ASCIIを含んでいて厳密にUTF-8として読めるなら、宣言(latin-1など)よりもUTF-8を信じる
+    if not body[: SNIFF_SIZE * 16].isascii() and _decodes(body, "utf-8"):
+        return "utf-8"
+    meta = META_CHARSET.search(body, 0, SNIFF_SIZE)
+    candidates = [_lookup(declared), _lookup(meta.group(1).decode("ascii")) if meta else None]
+    candidates = [c for c in candidates if c is not None] or ["utf-8"]
+    # ヘッダとmetaが食い違う・宣言が嘘のページがあるので、実際にデコードできるものを選ぶ
+    for encoding in candidates:
+        if _decodes(body, encoding):
+            return encoding
+    return candidates[0]
+
+
+def parse_html(body: bytes, encoding: str):
+    parsers = getattr(_local, "parsers", None)
+    if parsers is None:
+        parsers = _local.parsers = {}
+    try:
+        parser = parsers.get(encoding)
+        if parser is None:
+            parser = parsers[encoding] = lxml_html.HTMLParser(encoding=encoding)
+        return lxml_html.fromstring(body, parser=parser)
+    except LookupError:
+        # libxml2が対応していない文字コードはPython側でデコードする
+        return lxml_html.fromstring(body.decode(encoding, errors="replace"))
+
+
+def extract_from_bytes(body: bytes, encoding: str) -> dict:
+    # スレッド/プロセスプールで実行する。境界を越えるのはバイト列と結果のdictだけで、ツリーは持ち帰らない
+    return extract_metadata(parse_html(body, encoding))
+
+
+class Document:
+    """1リクエスト中に取得したページ。本文・最終URL・パース済みツリーを使い回す"""
+
+    __slots__ = ("url", "body", "encoding", "_tree", "_metadata")
+
+    def __init__(self, url: str, body: bytes, encoding: str | None = None, tree=None):
+        self.url = url
+        self.body = body
+        self.encoding = encoding or detect_encoding(body)
+        self._tree = tree
+        self._metadata = None
+
+    @property
+    def text(self) -> str:
+        return self.body.decode(self.encoding, errors="replace")
+
+    @property
+    def tree(self):
+        if self._tree is None:
+            with metrics.stage("parse"):
+                self._tree = parse_html(self.body, self.encoding)
+        return self._tree
+
+    @property
+    def metadata(self) -> dict:
+        if self._metadata is None:
+            tree = self.tree
+            with metrics.stage("extract"):
+                self._metadata = extract_metadata(tree)
+        return self._metadata
+
+    async def load_metadata(self, executor: Executor | None = None, threshold: int = OFFLOAD_THRESHOLD) -> dict:
+        if executor is None or self._metadata is not None or self._tree is not None or len(self.body) < threshold:
+            return self.metadata
+        # プールでの待ち時間も含めてparseとして計る
+        with metrics.stage("parse"):
+            self._metadata = await asyncio.get_running_loop().run_in_executor(
+                executor, extract_from_bytes, self.body, self.encoding
+            )
+        return self._metadata
@@ -0,0 +1,81 @@
+# 以前はフィールドごとにXPathで文書全体を走査していたが、meta/link/titleを一度だけ舐めて集める
+
+SENSITIVE_RATINGS = ("adult", "RTA-5042-1996-1400-1577-RTA")
+
+
+def _pick(*candidates):
+    # XPathの `a or b or c` と同じく、最初に見つかった候補を優先する
+    for table, key in candidates:
+        if key in table:
+            return table[key]
+    return None
+
+
+def extract_metadata(tree) -> dict:
+    meta_property = {}
+    meta_name = {}
+    link_rel = {}
+    link_type = {}
+    alternate = {}
+    text = {}
+
+    for el in tree.iter("meta", "link", "title"):
+        tag = el.tag
+        if tag == "meta":
+            content = el.get("content")
+            if content is None:
+                continue
+            prop = el.get("property")
+            if prop is not None and prop not in meta_property:
+                meta_property[prop] = content
+            name = el.get("name")
+            if name is not None and name not in meta_name:
+                meta_name[name] = content
+        elif tag == "link":
+            href = el.get("href")
+            if href is None:
+                continue
+            rel = el.get("rel")
+            type_ = el.get("type")
+            if rel is not None and rel not in link_rel:
+                link_rel[rel] = href
+            if type_ is not None:
+                if type_ not in link_type:
+                    link_type[type_] = href
+                if rel == "alternate" and type_ not in alternate:
+                    alternate[type_] = href
+        elif "title" not in text and el.text is not None:
+            text["title"] = el.text
+
+    rating = meta_name.get("rating")
+    return {
+        "title": _pick(
+            (meta_property, "og:title"),
+            (meta_name, "twitter:title"),
+            (text, "title"),
+        ),
+        "image": _pick(
+            (meta_property, "og:image"),
+            (meta_name, "twitter:image"),
+            (link_rel, "image_src"),
+            (link_rel, "apple-touch-icon"),
+        ),
+        "description": _pick(
+            (meta_property, "og:description"),
+            (meta_name, "twitter:description"),
+            (meta_name, "description"),
+        ),
+        "sitename": _pick(
+            (meta_property, "og:site_name"),
+            (meta_name, "application-name"),
+        ),
+        "favicon": _pick(
+            (link_rel, "shortcut icon"),
+            (link_rel, "icon"),
+        ),
+        "activitypub": alternate.get("application/activity+json"),
+        "oembed": link_type.get("application/json+oembed"),
+        "sensitive": meta_property.get("mixi:content-rating") == "1"
+        or rating in SENSITIVE_RATINGS,
+        "fediverseCreator": meta_name.get("fediverse:creator"),
+    }
@@ -0,0 +1,127 @@
+import contextvars
+import time
+from email.utils import parsedate_to_datetime
+
+import aiohttp
+from multidict import CIMultiDictProxy
+
+from . import metrics
+
+from .document import Document, detect_encoding
+
+CHUNK_SIZE = 64 * 1024
+HEAD_END = b"</head"
+
+
+class NotModified(Exception):
+    """条件付きリクエストに304が返ってきた。キャッシュ済みの要約をそのまま使える"""
+
+
+class Validators:
+    """要約の元になったページのETag/Last-Modifiedと、オリジンが示した有効期間"""
+
+    __slots__ = ("etag", "last_modified", "max_age")
+
+    def __init__(self, etag: str | None = None, last_modified: str | None = None, max_age: float | None = None):
+        self.etag = etag
+        self.last_modified = last_modified
+        self.max_age = max_age
+
+    def request_headers(self) -> dict[str, str]:
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+    def update(self, response: aiohttp.ClientResponse):
+        max_age = parse_max_age(response.headers)
+        if response.status == 304:
+            # 304では変わったものだけが返ってくる。Cache-Controlがなければ前回の有効期間のまま
+            self.etag = response.headers.get("ETag", self.etag)
+            self.last_modified = response.headers.get("Last-Modified", self.last_modified)
+            if max_age is not None:
+                self.max_age = max_age
+        else:
+            self.etag = response.headers.get("ETag")
+            self.last_modified = response.headers.get("Last-Modified")
+            self.max_age = max_age
+
+
+# SummaryCacheが取り直しのたびに設定する。ページ本体の取得だけがこれを見て条件付きリクエストにする
+revalidation: contextvars.ContextVar[Validators | None] = contextvars.ContextVar("pysummaly_revalidation", default=None)
+
+
+def parse_max_age(headers: CIMultiDictProxy[str]) -> float | None:
+    # 共有キャッシュとしてs-maxage > max-age > Expiresの順に見る。no-store/no-cacheは0
+    directives = {}
+    for part in headers.get("Cache-Control", "").split(","):
+        name, _, value = part.strip().partition("=")
+        directives[name.lower()] = value.strip('"')
+    if "no-store" in directives or "no-cache" in directives:
+        return 0.0
+    for name in ("s-maxage", "max-age"):
+        if directives.get(name, "").isdigit():
+            return float(directives[name])
+    expires = headers.get("Expires")
+    if expires:
+        try:
+            return max(parsedate_to_datetime(expires).timestamp() - time.time(), 0.0)
+        except (TypeError, ValueError):
+            # Expires: 0 などの不正な値は期限切れとみなす
+            return 0.0
+    return None
+
+
+def check_content_length(response: aiohttp.ClientResponse, content_length_limit, content_length_required):
+    if content_length_required and response.content_length is None:
+        raise aiohttp.ClientPayloadError("Content length required but not provided")
+    if content_length_limit:
+        if response.content_length and response.content_length > content_length_limit:
+            raise aiohttp.ClientPayloadError("Content length exceeds limit")
+
+
+async def read_body(response: aiohttp.ClientResponse, content_length_limit=None, head_only: bool = False) -> bytes:
+    # Content-Lengthがないchunkedなレスポンスでも読みながら上限を見る
+    # head_onlyの場合はメタデータがある</head>まで読めたら打ち切る
+    chunks = []
+    size = 0
+    tail = b""
+    with metrics.stage("body"):
+        try:
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                size += len(chunk)
+                if content_length_limit and size > content_length_limit:
+                    raise aiohttp.ClientPayloadError("Content length exceeds limit")
+                chunks.append(chunk)
+                if head_only:
+                    window = tail + chunk
+                    if HEAD_END in window.lower():
+                        break
+                    tail = window[-(len(HEAD_END) - 1):]
+        finally:
+            metrics.downloaded_bytes.inc(size)
+    return b"".join(chunks)
+
+
+async def read_document(
+    response: aiohttp.ClientResponse,
+    content_length_limit=None,
+    content_length_required=False,
+    head_only: bool = False,
+) -> Document:
+    # 文字列にデコードせずバイト列のままlxmlに渡す
+    check_content_length(response, content_length_limit, content_length_required)
+    body = await read_body(response, content_length_limit, head_only=head_only)
+    return Document(str(response.url), body, detect_encoding(body, response.charset))
+
+
+async def read_text(
+    response: aiohttp.ClientResponse,
+    content_length_limit=None,
+    content_length_required=False,
+    head_only: bool = False,
+) -> str:
+    doc = await read_document(response, content_length_limit, content_length_required, head_only=head_only)
+    return doc.text
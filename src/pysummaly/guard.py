@@ -0,0 +1,118 @@
+# SSRF対策。名前解決と接続先の検証をコネクタのリゾルバで一度に行うので、
+# 検証したアドレスにそのまま接続される(DNS rebindingの隙がない)。リダイレクト先も同じリゾルバを通る
+import ipaddress
+import socket
+from types import SimpleNamespace
+
+import aiohttp
+import yarl
+from aiohttp.abc import AbstractResolver
+
+from . import metrics
+from .cache import TTLCache
+from .singleflight import SingleFlight
+
+
+class ForbiddenAddress(Exception):
+    pass
+
+
+def is_public_address(address: str) -> bool:
+    ip = ipaddress.ip_address(address.split("%", 1)[0])
+    if ip.version == 6 and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    # is_globalはprivate/loopback/link-local/ULA/CGNATなどを除外する
+    return ip.is_global and not ip.is_multicast
+
+
+def is_allowed_address(address: str, allow_networks=()) -> bool:
+    # allow_networksはベンチマークや社内向けに明示的に許可したネットワーク
+    if allow_networks:
+        ip = ipaddress.ip_address(address.split("%", 1)[0])
+        if any(ip in network for network in allow_networks):
+            return True
+    return is_public_address(address)
+
+
+def check_host(host: str | None, allow_networks=()):
+    if not host:
+        raise ForbiddenAddress("URL has no host")
+    try:
+        public = is_allowed_address(host.strip("[]"), allow_networks)
+    except ValueError:
+        # IPアドレスでないホスト名はリゾルバ側で検証する
+        return
+    if not public:
+        raise ForbiddenAddress(f"Access to local IPs is denied: {host}")
+
+
+class GuardedResolver(AbstractResolver):
+    def __init__(
+        self,
+        resolver: AbstractResolver | None = None,
+        ttl: float = 300,
+        maxsize: int = 10000,
+        allow_networks=(),
+    ):
+        self._resolver = resolver
+        # 渡されたリゾルバは呼び出し側が閉じる。自分で作ったものだけclose()で閉じる
+        self._owns_resolver = resolver is None
+        self.allow_networks = tuple(allow_networks)
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._flights = SingleFlight()
+
+    async def resolve(self, host: str, port: int = 0, family: socket.AddressFamily = socket.AF_INET):
+        key = (host, port, family)
+        infos = self._cache.get(key)
+        metrics.cache_result("dns", infos is not None)
+        if infos is None:
+            if self._resolver is None:
+                self._resolver = aiohttp.DefaultResolver()
+            with metrics.stage("dns"):
+                infos = await self._flights.do(key, self._resolver.resolve, host, port, family)
+            self._cache.set(key, infos)
+        for info in infos:
+            if not is_allowed_address(info["host"], self.allow_networks):
+                raise ForbiddenAddress(f"Access to local IPs is denied: {host}")
+        return infos
+
+    async def close(self):
+        if self._owns_resolver and self._resolver is not None:
+            resolver, self._resolver = self._resolver, None
+            await resolver.close()
+
+
+class GuardTraceConfig(aiohttp.TraceConfig):
+    """trace_config()が返す。セッションに検証が入っているかをis_guarded()で確かめるための印"""
+
+
+def trace_config(allow_networks=()) -> aiohttp.TraceConfig:
+    # IPアドレス直書きのURLはリゾルバを通らないので、リクエスト開始時とリダイレクト時に見る
+    allow_networks = tuple(allow_networks)
+
+    async def on_request_start(session, context: SimpleNamespace, params: aiohttp.TraceRequestStartParams):
+        check_host(params.url.host, allow_networks)
+
+    async def on_request_redirect(session, context: SimpleNamespace, params: aiohttp.TraceRequestRedirectParams):
+        location = params.response.headers.get("Location")
+        if location:
+            check_host(params.url.join(yarl.URL(location)).host, allow_networks)
+
+    config = GuardTraceConfig()
+    config.on_request_start.append(on_request_start)
+    config.on_request_redirect.append(on_request_redirect)
+    return config
+
+
+def is_guarded(session: aiohttp.ClientSession) -> bool:
+    # 接続先の検証はリゾルバ(ホスト名)とtrace config(IPアドレス直書きとリダイレクト)の両方がそろって効く
+    resolver = getattr(session.connector, "_resolver", None)
+    return isinstance(resolver, GuardedResolver) and any(
+        isinstance(config, GuardTraceConfig) for config in session.trace_configs
+    )
+
+
+def require_guard(session: aiohttp.ClientSession):
+    # 呼び出し側が用意したセッションでは内部アドレスへの接続を止められないので、使わずに断る
+    if not is_guarded(session):
+        raise ForbiddenAddress("session is not guarded against local addresses; create it with Summarizer.session()")
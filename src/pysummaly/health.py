@@ -0,0 +1,165 @@
+# ホストごとの応答時間と失敗の統計。失敗が続くホストへのリクエストはサーキットブレーカーで即座に失敗させ、
+# 遅いリクエストにはホストのp95を過ぎたところで2本目を並行して送る(ヘッジ)
+import asyncio
+import contextvars
+import time
+from collections import deque
+from collections.abc import Awaitable, Callable
+from types import SimpleNamespace
+from typing import TypeVar
+
+import aiohttp
+
+from . import metrics
+from .cache import TTLCache
+
+T = TypeVar("T")
+
+
+class CircuitOpen(aiohttp.ClientConnectionError):
+    """失敗が続いているホストへのリクエストを送らずに失敗させる"""
+
+
+class HostStats:
+    __slots__ = ("latencies", "failures", "opened_until")
+
+    def __init__(self, window: int):
+        # 最近の成功したGETのレスポンスヘッダまでの秒数(HEADは速すぎるので混ぜない)
+        self.latencies: deque[float] = deque(maxlen=window)
+        # 連続した失敗の回数
+        self.failures = 0
+        self.opened_until = 0.0
+
+    def percentile(self, q: float) -> float:
+        ordered = sorted(self.latencies)
+        return ordered[min(int(len(ordered) * q), len(ordered) - 1)]
+
+
+class HostHealth:
+    def __init__(
+        self,
+        failure_threshold: int = 5,
+        open_seconds: float = 30,
+        window: int = 100,
+        hedge: bool = False,
+        hedge_min_samples: int = 20,
+        hedge_min_delay: float = 0.05,
+        maxsize: int = 10000,
+    ):
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.window = window
+        self.hedge = hedge
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_min_delay = hedge_min_delay
+        self._hosts = TTLCache(maxsize=maxsize, ttl=600)
+
+    def stats(self, host: str) -> HostStats:
+        stats = self._hosts.get(host)
+        if stats is None:
+            stats = HostStats(self.window)
+        self._hosts.set(host, stats)
+        return stats
+
+    def check(self, host: str):
+        stats = self.stats(host)
+        if stats.failures < self.failure_threshold:
+            return
+        now = time.monotonic()
+        if now < stats.opened_until:
+            metrics.circuit_rejections.inc()
+            raise CircuitOpen(f"{host} is failing; not sending requests for a while")
+        # 開いている期間を過ぎたら1本だけ様子見で通し、その結果が出るまで他は止めておく
+        stats.opened_until = now + self.open_seconds
+
+    def record(self, host: str, seconds: float, ok: bool, sample: bool = True):
+        # sample=Falseなら成否だけ数え、応答時間はヘッジの統計に入れない
+        stats = self.stats(host)
+        if ok:
+            if sample:
+                stats.latencies.append(seconds)
+            stats.failures = 0
+            stats.opened_until = 0.0
+            return
+        stats.failures += 1
+        if stats.failures >= self.failure_threshold:
+            stats.opened_until = time.monotonic() + self.open_seconds
+
+    def hedge_delay(self, host: str) -> float | None:
+        # 統計が十分にあるときだけ、p95を過ぎたら2本目を送る
+        if not self.hedge:
+            return None
+        stats = self.stats(host)
+        if len(stats.latencies) < self.hedge_min_samples:
+            return None
+        return max(stats.percentile(0.95), self.hedge_min_delay)
+
+    def trace_config(self) -> aiohttp.TraceConfig:
+        async def on_request_start(session, context: SimpleNamespace, params: aiohttp.TraceRequestStartParams):
+            self.check(params.url.host or "")
+            context.health_start = time.perf_counter()
+
+        async def on_request_end(session, context: SimpleNamespace, params: aiohttp.TraceRequestEndParams):
+            # 4xxはホストの不調ではないので失敗に数えない
+            elapsed = time.perf_counter() - context.health_start
+            self.record(params.url.host or "", elapsed, params.response.status < 500, sample=params.method == "GET")
+
+        async def on_request_exception(session, context: SimpleNamespace, params: aiohttp.TraceRequestExceptionParams):
+            start = getattr(context, "health_start", None)
+            # ブレーカーで止めたもの・ヘッジで取り消した方は数えない
+            if start is None or isinstance(params.exception, (CircuitOpen, asyncio.CancelledError)):
+                return
+            self.record(params.url.host or "", time.perf_counter() - start, False)
+
+        config = aiohttp.TraceConfig()
+        config.on_request_start.append(on_request_start)
+        config.on_request_end.append(on_request_end)
+        config.on_request_exception.append(on_request_exception)
+        return config
+
+
+# Summarizerが要約のたびに設定する。ページ本体の取得がこれを見てヘッジするか決める
+current: contextvars.ContextVar[HostHealth | None] = contextvars.ContextVar("pysummaly_health", default=None)
+
+
+async def hedged(
+    host: str,
+    fn: Callable[[], Awaitable[T]],
+    deadline: float | None = None,
+    discard: Callable[[T], object] | None = None,
+) -> T:
+    # fnは冪等なGETであること。先に終わった方の結果を使い、もう一方は取り消す。
+    # 使わなかった方も終わっていた場合は、その結果をdiscardに渡して片付ける(レスポンスの解放など)
+    health = current.get()
+    delay = health.hedge_delay(host) if health is not None else None
+    loop = asyncio.get_running_loop()
+    if delay is None or (deadline is not None and loop.time() + delay >= deadline):
+        return await fn()
+
+    first = asyncio.ensure_future(fn())
+    second = None
+    winner = None
+    try:
+        done, _ = await asyncio.wait({first}, timeout=delay)
+        if done:
+            winner = first
+            return first.result()
+        second = asyncio.ensure_future(fn())
+        pending = {first, second}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            # 同時に終わった場合は成功した方を優先する
+            for task in sorted(done, key=lambda t: t.exception() is not None):
+                # 片方が失敗しても、もう一方がまだ走っていればそちらを待つ
+                if task.exception() is None or not pending:
+                    winner = task
+                    metrics.hedged_requests.inc(winner="first" if task is first else "second")
+                    return task.result()
+    finally:
+        for task in (first, second):
+            if task is None or task is winner:
+                continue
+            if not task.done():
+                task.cancel()
+            elif discard is not None and not task.cancelled() and task.exception() is None:
+                discard(task.result())
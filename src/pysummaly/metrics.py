@@ -0,0 +1,221 @@
+# Prometheusのテキスト形式で出せる最小限のメトリクス。prometheus_clientには依存しない
+import asyncio
+import socket
+import threading
+import time
+from collections.abc import Callable
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+import aiohttp
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _labels(labelnames: tuple[str, ...], labels: dict) -> tuple[str, ...]:
+    return tuple(str(labels.get(name, "")) for name in labelnames)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(pairs) -> str:
+    body = ",".join(f'{k}="{_escape(v)}"' for k, v in pairs)
+    return "{" + body + "}" if body else ""
+
+
+class Metric:
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = (), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(self._samples())
+        return lines
+
+    def _samples(self) -> list[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = _labels(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self._values.get(_labels(self.labelnames, labels), 0)
+
+    def _samples(self):
+        return [
+            f"{self.name}{_format_labels(zip(self.labelnames, key))} {value}"
+            for key, value in self._values.items()
+        ]
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    @contextmanager
+    def track(self, **labels):
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, *args, buckets: tuple[float, ...] = DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets))
+        self._values: dict[tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels):
+        key = _labels(self.labelnames, labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # [バケットごとの件数..., 合計, 件数]
+                counts = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            counts[-2] += value
+            counts[-1] += 1
+
+    def totals(self) -> dict[tuple[str, ...], tuple[int, float]]:
+        # ラベルごとの (件数, 合計)
+        return {key: (counts[-1], counts[-2]) for key, counts in self._values.items()}
+
+    def _samples(self):
+        lines = []
+        for key, counts in self._values.items():
+            pairs = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(pairs + [('le', str(bound))])} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(pairs + [('le', '+Inf')])} {counts[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(pairs)} {counts[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(pairs)} {counts[-1]}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: list[Metric] = []
+
+    def register(self, metric: Metric):
+        self.metrics.append(metric)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+stage_seconds = Histogram("pysummaly_stage_seconds", "Time spent in each stage of summarize()", ("stage",))
+plugin_seconds = Histogram("pysummaly_plugin_seconds", "Time spent in each plugin", ("plugin",))
+cache_requests = Counter("pysummaly_cache_requests_total", "Cache lookups by cache and result", ("cache", "result"))
+in_flight = Gauge("pysummaly_in_flight", "Operations currently running", ("kind",))
+downloaded_bytes = Counter("pysummaly_downloaded_bytes_total", "Response body bytes downloaded")
+errors = Counter("pysummaly_errors_total", "Failed summaries by category", ("category",))
+circuit_rejections = Counter("pysummaly_circuit_rejections_total", "Requests refused because the host's circuit is open")
+hedged_requests = Counter("pysummaly_hedged_requests_total", "Hedged page requests by which request finished first", ("winner",))
+
+# (stage, 秒数) を受け取るフック。ログやトレースに流したい場合に登録する
+stage_hooks: list[Callable[[str, float], None]] = []
+
+
+def add_stage_hook(hook: Callable[[str, float], None]):
+    stage_hooks.append(hook)
+
+
+def observe_stage(name: str, seconds: float):
+    stage_seconds.observe(seconds, stage=name)
+    for hook in stage_hooks:
+        hook(name, seconds)
+
+
+@contextmanager
+def stage(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(name, time.perf_counter() - start)
+
+
+def cache_result(cache: str, hit: bool):
+    cache_requests.inc(cache=cache, result="hit" if hit else "miss")
+
+
+def error_category(e: BaseException) -> str:
+    # 循環importを避けるためクラス名で判定する
+    name = type(e).__name__
+    if isinstance(e, (asyncio.TimeoutError, TimeoutError)):
+        return "timeout"
+    if name == "ForbiddenAddress":
+        return "forbidden"
+    if name == "CircuitOpen":
+        return "circuit"
+    if isinstance(e, aiohttp.ClientPayloadError):
+        return "payload"
+    if isinstance(e, socket.gaierror) or isinstance(getattr(e, "os_error", None), socket.gaierror):
+        return "dns"
+    if isinstance(e, aiohttp.ClientResponseError):
+        return "http"
+    if isinstance(e, aiohttp.ClientError):
+        return "connection"
+    if name in ("ParserError", "XMLSyntaxError", "JSONDecodeError"):
+        return "parse"
+    return "other"
+
+
+async def _on_request_start(session, context: SimpleNamespace, params):
+    context.request_start = time.perf_counter()
+
+
+async def _on_connection_create_start(session, context: SimpleNamespace, params):
+    context.connect_start = time.perf_counter()
+
+
+async def _on_connection_create_end(session, context: SimpleNamespace, params):
+    observe_stage("connect", time.perf_counter() - context.connect_start)
+
+
+async def _on_request_end(session, context: SimpleNamespace, params):
+    # レスポンスヘッダを受け取った時点 = TTFB
+    observe_stage("ttfb", time.perf_counter() - context.request_start)
+
+
+def trace_config() -> aiohttp.TraceConfig:
+    config = aiohttp.TraceConfig()
+    config.on_request_start.append(_on_request_start)
+    config.on_connection_create_start.append(_on_connection_create_start)
+    config.on_connection_create_end.append(_on_connection_create_end)
+    config.on_request_end.append(_on_request_end)
+    return config
@@ -1,10 +1,134 @@
-from typing import Coroutine, Any
+# 各プラグインはモジュール(またはそれに準ずるオブジェクト)で、以下を宣言する
+#   HOSTS: 完全一致するホスト名
+#   HOST_SUFFIXES: このドメイン配下のサブドメインすべて(例: "app.link" は "foo.app.link" に一致)
+#   HOST_PATTERNS: 上のどちらでも表せない場合のコンパイル済み正規表現
+#   test(url): SUFFIXES/PATTERNSで当たったときの最終確認(任意)
+# と、処理として fetch(**args) -> Document / summarize(url, session) -> Summary / get_oembed_player(**args) -> Player のいずれか
+# (以前のように辞書を返すプラグインも受け付ける)
+import importlib
+import logging
+import time
+from typing import Any
 
 import aiohttp
 import yarl
-from lxml import html
 
-from . import skeb, branchio, wikipedia, youtube
+from .. import metrics
+from ..document import Document
+from ..result import Player, Summary
+
+logger = logging.getLogger(__name__)
+
+ENTRY_POINT_GROUP = "pysummaly.plugins"
+# 同梱のプラグイン。最初に振り分けが必要になったときに読み込む
+BUILTIN_PLUGINS = ("skeb", "branchio", "wikipedia", "youtube")
+
+
+def plugin_name(plugin) -> str:
+    return getattr(plugin, "__name__", type(plugin).__name__).rsplit(".", 1)[-1]
+
+
+class HostTrie:
+    """ホスト名をラベル単位で右から辿るサフィックス木"""
+
+    def __init__(self):
+        self._root: dict = {}
+
+    def add(self, suffix: str, value):
+        node = self._root
+        for label in reversed(suffix.lower().strip(".").split(".")):
+            node = node.setdefault(label, {})
+        node[None] = value
+
+    def find(self, host: str):
+        # 一番長く一致したサフィックスを返す。サフィックスそのもの(app.link)には一致させない
+        labels = host.split(".")
+        node = self._root
+        found = None
+        for depth, label in enumerate(reversed(labels), 1):
+            node = node.get(label)
+            if node is None:
+                break
+            if None in node and depth < len(labels):
+                found = node[None]
+        return found
+
+
+class PluginRegistry:
+    def __init__(self, builtins: tuple[str, ...] = (), entry_point_group: str | None = None):
+        self.plugins: list = []
+        self._hosts: dict[str, Any] = {}
+        self._suffixes = HostTrie()
+        self._patterns: list = []
+        # 読み込みを遅らせているプラグイン(同梱モジュール名とエントリポイントのグループ)
+        self._builtins = builtins
+        self._entry_point_group = entry_point_group
+        self._loaded = not builtins and entry_point_group is None
+
+    def load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        for name in self._builtins:
+            self.register(importlib.import_module(f".{name}", __name__))
+        if self._entry_point_group is not None:
+            self.load_entry_points(self._entry_point_group)
+
+    def register(self, plugin):
+        # 後から登録したものが同梱のものより優先されるよう、先に同梱のものを読み込んでおく
+        self.load()
+        self.plugins.append(plugin)
+        for host in getattr(plugin, "HOSTS", ()):
+            self._hosts[host.lower()] = plugin
+        for suffix in getattr(plugin, "HOST_SUFFIXES", ()):
+            self._suffixes.add(suffix, plugin)
+        for pattern in getattr(plugin, "HOST_PATTERNS", ()):
+            self._patterns.append((pattern, plugin))
+        return plugin
+
+    def load_entry_points(self, group: str = ENTRY_POINT_GROUP):
+        from importlib.metadata import entry_points
+
+        for ep in entry_points(group=group):
+            try:
+                self.register(ep.load())
+            except Exception:
+                logger.exception("Failed to load plugin %s", ep.name, extra={"plugin": ep.name})
+
+    async def lookup(self, url: yarl.URL):
+        self.load()
+        host = url.host
+        if not host:
+            return None
+        host = host.lower()
+        plugin = self._hosts.get(host)
+        if plugin is not None:
+            return plugin
+        plugin = self._suffixes.find(host)
+        if plugin is None:
+            for pattern, candidate in self._patterns:
+                if pattern.match(host):
+                    plugin = candidate
+                    break
+        if plugin is None:
+            return None
+        test = getattr(plugin, "test", None)
+        if test is not None and not await test(url):
+            return None
+        return plugin
+
+
+registry = PluginRegistry(BUILTIN_PLUGINS, ENTRY_POINT_GROUP)
+
+
+async def _timed(plugin, coro):
+    start = time.perf_counter()
+    try:
+        return await coro
+    finally:
+        elapsed = time.perf_counter() - start
+        metrics.plugin_seconds.observe(elapsed, plugin=plugin_name(plugin))
+        metrics.observe_stage("plugin", elapsed)
 
 
 async def check(
@@ -13,22 +137,45 @@ async def check(
     timeout,
     content_length_limit,
     content_length_required,
-    no_oembed: bool=False
-) -> Coroutine[Any, Any, dict] | None:
+) -> Document | Summary | dict[str, Any] | None:
     url_parsed: yarl.URL = yarl.URL(url)
-    args = {
-        "session": session,
-        "url": url,
-        "timeout": timeout,
-        "content_length_limit": content_length_limit,
-        "content_length_required": content_length_required,
-    }
-    if await skeb.test(url_parsed):
-        return html.fromstring(await skeb.fetch(**args))
-    elif await branchio.test(url_parsed):
-        return html.fromstring(await branchio.fetch(**args))
-    elif await wikipedia.test(url_parsed):
-        return await wikipedia.summarize(url_parsed, session)
-    elif await youtube.test(url_parsed) and not no_oembed:
-        return await youtube.get_oembed_player(**args)
-    return None
\ No newline at end of file
+    plugin = await registry.lookup(url_parsed)
+    if plugin is None:
+        return None
+    if hasattr(plugin, "summarize"):
+        return await _timed(plugin, plugin.summarize(url_parsed, session))
+    if hasattr(plugin, "fetch"):
+        return await _timed(
+            plugin,
+            plugin.fetch(
+                session=session,
+                url=url,
+                timeout=timeout,
+                content_length_limit=content_length_limit,
+                content_length_required=content_length_required,
+            ),
+        )
+    return None
+
+
+async def player(
+    session: aiohttp.ClientSession,
+    url: str,
+    timeout,
+    content_length_limit,
+    content_length_required,
+) -> Player | None:
+    plugin = await registry.lookup(yarl.URL(url))
+    if plugin is None or not hasattr(plugin, "get_oembed_player"):
+        return None
+    result = await _timed(
+        plugin,
+        plugin.get_oembed_player(
+            session=session,
+            url=url,
+            timeout=timeout,
+            content_length_limit=content_length_limit,
+            content_length_required=content_length_required,
+        ),
+    )
+    return Player.from_dict(result) if isinstance(result, dict) else result
@@ -1,17 +1,20 @@
 # SkebはRetry-After: 0な429を返すらしい
-import asyncio
-import ipaddress
 import re
 
 import aiohttp
 import yarl
 from lxml import html
 
+from ..fetcher import read_document
+
+
+HOSTS = ("skeb.jp", "ske.be")
+
 
 async def test(url: yarl.URL) -> bool:
     if not url.host:
         return False
-    return url.host == "skeb.jp" or url.host == "ske.be"
+    return url.host in HOSTS
 
 async def find_request_key(html_content: str) -> str:
     tree = html.fromstring(html_content)
@@ -36,26 +39,13 @@ async def fetch(
     content_length_limit,
     content_length_required,
 ):
-    try:
-        resolver = aiohttp.DefaultResolver()
-        infos = await resolver.resolve(url.split("://")[-1].split("/")[0], 0)
-        for info in infos:
-            ip = ipaddress.ip_address(info["host"])
-            if ip.is_private or ip.is_loopback:
-                raise Exception("Access to local IPs is denied.")
-    except Exception as e:
-        raise Exception(f"DNS resolution failed: {e}")
     async with session.get(url, timeout=timeout) as r:
-        if r.status == 429:
-            await asyncio.sleep(int(r.headers.get("Retry-After")))
-            request_key = await find_request_key(await r.text())
-            async with session.get(url, timeout=timeout, cookies={"request_key": request_key}) as response:
-                if content_length_required and response.content_length is None:
-                    raise aiohttp.ClientPayloadError("Content length required but not provided")
-                if content_length_limit:
-                    if (
-                        response.content_length
-                        and response.content_length > content_length_limit
-                    ):
-                        raise aiohttp.ClientPayloadError("Content length exceeds limit")
-                return await response.text()
+        if r.status != 429:
+            return await read_document(r, content_length_limit, content_length_required, head_only=True)
+        # Retry-Afterの待ちはスケジューラがホスト単位で行うので、ここでは眠らない
+        page = await read_document(r, content_length_limit, content_length_required)
+        request_key = await find_request_key(page.text)
+        async with session.get(url, timeout=timeout, cookies={"request_key": request_key}) as response:
+            return await read_document(
+                response, content_length_limit, content_length_required, head_only=True
+            )
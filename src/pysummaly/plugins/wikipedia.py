@@ -1,51 +1,191 @@
+import asyncio
+import logging
 import re
 
 import aiohttp
+import orjson
 import yarl
 
+from .. import metrics
+from ..cache import MISSING, TTLCache
+from ..fetcher import read_body
+from ..result import Summary
+from ..scheduler import deadline as request_deadline
+
+logger = logging.getLogger(__name__)
+
 def clip(text: str, length: int) -> str:
     if len(text) > length:
         return text[:length] + "..."
     else:
         return text
 
+API_ENDPOINT = "https://{lang}.wikipedia.org/w/api.php"
+
+HOST_SUFFIXES = ("wikipedia.org",)
+HOST_PATTERN = re.compile(r"[a-zA-Z]{2}\.wikipedia\.org$")
+
+# 同じ言語版への問い合わせはこの時間だけ待ってから1回のAPI呼び出しにまとめる
+BATCH_WINDOW = 0.01
+# prop=extractsでexintroを使う場合、1回に返せるのは20件まで
+MAX_TITLES = 20
+# 待っている呼び出しの残り時間がこれより短ければ、そちらに合わせる
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=5)
+THUMBNAIL_SIZE = 640
+
+# (言語, タイトル)ごとの本文冒頭と画像。存在しない記事はNoneで覚える
+extract_cache = TTLCache(maxsize=10000, ttl=60 * 60)
+
+
 async def test(url: yarl.URL) -> bool:
     if not url.host:
         return False
-    m = True if re.match(r"[a-zA-Z]{2}\.wikipedia\.org$", url.host) else False
-    return m
+    return HOST_PATTERN.match(url.host) is not None
+
+
+class _Batch:
+    __slots__ = ("titles", "sessions", "deadline", "full")
+
+    def __init__(self):
+        self.titles: dict[str, asyncio.Future] = {}
+        self.sessions: list[aiohttp.ClientSession] = []
+        # 待ち手の期限(loop.time())のうち最も早いもの
+        self.deadline: float | None = None
+        self.full = asyncio.Event()
+
+    def timeout(self) -> aiohttp.ClientTimeout:
+        if self.deadline is None:
+            return REQUEST_TIMEOUT
+        remaining = self.deadline - asyncio.get_running_loop().time()
+        if remaining <= 0:
+            raise asyncio.TimeoutError()
+        return aiohttp.ClientTimeout(total=min(REQUEST_TIMEOUT.total, remaining))
+
+
+class Batcher:
+    """同時に来た同じ言語版へのタイトルをtitles=A|B|Cの1リクエストにまとめる"""
+
+    def __init__(self):
+        self._pending: dict[str, _Batch] = {}
+
+    async def lookup(self, session: aiohttp.ClientSession, lang: str, title: str):
+        batch = self._pending.get(lang)
+        if batch is None:
+            batch = self._pending[lang] = _Batch()
+            asyncio.ensure_future(self._run(lang, batch))
+        deadline = request_deadline.get()
+        if deadline is not None and (batch.deadline is None or deadline < batch.deadline):
+            batch.deadline = deadline
+        future = batch.titles.get(title)
+        if future is None:
+            future = batch.titles[title] = asyncio.get_running_loop().create_future()
+            if session not in batch.sessions:
+                batch.sessions.append(session)
+            if len(batch.titles) >= MAX_TITLES:
+                # 上限に達したらすぐ送り、次の問い合わせは新しいバッチに入れる
+                del self._pending[lang]
+                batch.full.set()
+        # 待ち手がキャンセルされても、同じタイトルを待つ他の呼び出しには結果を返す
+        return await asyncio.shield(future)
+
+    async def _run(self, lang: str, batch: _Batch):
+        try:
+            await asyncio.wait_for(batch.full.wait(), BATCH_WINDOW)
+        except asyncio.TimeoutError:
+            pass
+        if self._pending.get(lang) is batch:
+            del self._pending[lang]
+        try:
+            # 呼び出し元のセッションのうち、まだ閉じていないものを使う
+            session = next((s for s in batch.sessions if not s.closed), None)
+            if session is None:
+                raise aiohttp.ClientConnectionError("all sessions waiting for the batch are closed")
+            results = await query(session, lang, list(batch.titles), batch.timeout())
+        except Exception as e:
+            for future in batch.titles.values():
+                if not future.done():
+                    future.set_exception(e)
+                    # 待ち手がいなくなっていても "exception was never retrieved" を出さない
+                    future.exception()
+            return
+        for title, future in batch.titles.items():
+            if not future.done():
+                future.set_result(results.get(title))
+
+
+batcher = Batcher()
+
+
+async def query(
+    session: aiohttp.ClientSession, lang: str, titles: list[str], timeout: aiohttp.ClientTimeout = REQUEST_TIMEOUT
+) -> dict[str, dict | None]:
+    # リダイレクトの解決と記事の代表画像の取得も同じ呼び出しで済ませる
+    params = {
+        "action": "query",
+        "format": "json",
+        "formatversion": "2",
+        "prop": "extracts|pageimages",
+        "exintro": "1",
+        "explaintext": "1",
+        "exlimit": str(MAX_TITLES),
+        "piprop": "thumbnail",
+        "pithumbsize": str(THUMBNAIL_SIZE),
+        "pilimit": str(MAX_TITLES),
+        "redirects": "1",
+        "titles": "|".join(titles),
+    }
+    endpoint = yarl.URL(API_ENDPOINT.format(lang=lang)).with_query(params)
+    logger.debug("wikipedia lookup", extra={"lang": lang, "titles": len(titles), "endpoint": str(endpoint)})
+    async with session.get(endpoint, timeout=timeout) as resp:
+        body = orjson.loads(await read_body(resp))
+    if "query" not in body or "pages" not in body["query"]:
+        raise Exception("fetch failed")
+
+    # 要求したタイトル → 正規化後のタイトル → リダイレクト先 の順にたどる
+    aliases = {}
+    for item in body["query"].get("normalized", []) + body["query"].get("redirects", []):
+        aliases[item["from"]] = item["to"]
+    pages = {page["title"]: page for page in body["query"]["pages"]}
+
+    results = {}
+    for title in titles:
+        resolved = title
+        for _ in range(3):
+            resolved = aliases.get(resolved, resolved)
+        page = pages.get(resolved)
+        if page is None or page.get("missing") or page.get("invalid"):
+            info = None
+        else:
+            info = {
+                "title": page["title"],
+                "extract": page.get("extract", ""),
+                "thumbnail": page.get("thumbnail", {}).get("source"),
+            }
+        extract_cache.set((lang, title), info)
+        results[title] = info
+    return results
+
 
 async def summarize(url: yarl.URL, session: aiohttp.ClientSession):
-    try:
-        lang = url.host.split(".")[0]
-    except IndexError:
-        lang = None
-    try:
-        title = url.path.split("/")[2]
-    except IndexError:
-        title = None
-    endpoint = f"https://{lang}.wikipedia.org/w/api.php?format=json&action=query&prop=extracts&exintro=&explaintext=&titles={title}"
-    
-    print(f'lang is {lang}')
-    print(f'title is {title}')
-    print(f'endpoint is {endpoint}')
-    async with session.get(endpoint) as resp:
-        body = await resp.json()
-        if 'query' not in body or 'pages' not in body['query']:
-            raise Exception("fetch failed")
-        info = body['query']['pages'][list(body['query']['pages'].keys())[0]]
-        return {
-            'title': info['title'],
-            'icon': 'https://wikipedia.org/static/favicon/wikipedia.ico',
-            'description': clip(info['extract'], 300),
-            'thumbnail': f'https://wikipedia.org/static/images/project-logos/{lang}wiki.png',
-            'player': {
-                'url': None,
-                'width': None,
-                'height': None,
-                'allow': [],
-            },
-            'sitename': 'Wikipedia',
-            'fediverseCreator': None,
-            'activityPub': None,
-        }
\ No newline at end of file
+    lang = url.host.split(".")[0]
+    if not url.path.startswith("/wiki/"):
+        return None
+    title = url.path[len("/wiki/"):].replace("_", " ")
+    if not title:
+        return None
+
+    info = extract_cache.get((lang, title), MISSING)
+    metrics.cache_result("wikipedia", info is not MISSING)
+    if info is MISSING:
+        info = await batcher.lookup(session, lang, title)
+    if info is None:
+        # 記事がなければ通常のページとして要約する
+        return None
+    return Summary(
+        title=info['title'],
+        icon='https://wikipedia.org/static/favicon/wikipedia.ico',
+        description=clip(info['extract'], 300),
+        thumbnail=info['thumbnail'],
+        sitename='Wikipedia',
+        url=str(url),
+    )
@@ -1,21 +1,27 @@
 # SkebはRetry-After: 0な429を返すらしい
 from urllib.parse import quote, urlparse
+import logging
 import re
-import ipaddress
 
 import aiohttp
+import orjson
 import yarl
 from lxml import html
 
+from ..fetcher import check_content_length, read_body
+from ..result import Player
+
+logger = logging.getLogger(__name__)
+
+
+HOSTS = ("youtube.com", "youtu.be", "www.youtube.com")
+OEMBED_ENDPOINT = "https://www.youtube.com/oembed"
+
 
 async def test(url: yarl.URL) -> bool:
     if not url.host:
         return False
-    return (
-        url.host == "youtube.com"
-        or url.host == "youtu.be"
-        or url.host == "www.youtube.com"
-    )
+    return url.host in HOSTS
 
 
 async def get_oembed_player(
@@ -25,27 +31,11 @@ async def get_oembed_player(
     content_length_limit,
     content_length_required,
 ):
-    try:
-        resolver = aiohttp.DefaultResolver()
-        infos = await resolver.resolve(url.split("://")[-1].split("/")[0], 0)
-        for info in infos:
-            ip = ipaddress.ip_address(info["host"])
-            if ip.is_private or ip.is_loopback:
-                raise Exception("Access to local IPs is denied.")
-    except Exception as e:
-        raise Exception(f"DNS resolution failed: {e}")
     async with session.get(
-        "https://www.youtube.com/oembed?format=json&url=" + quote(url), timeout=timeout
+        OEMBED_ENDPOINT + "?format=json&url=" + quote(url), timeout=timeout
     ) as response:
-        if content_length_required and response.content_length is None:
-            raise aiohttp.ClientPayloadError("Content length required but not provided")
-        if content_length_limit:
-            if (
-                response.content_length
-                and response.content_length > content_length_limit
-            ):
-                raise aiohttp.ClientPayloadError("Content length exceeds limit")
-        r = await response.json()
+        check_content_length(response, content_length_limit, content_length_required)
+        r = orjson.loads(await read_body(response, content_length_limit))
         tree = html.fromstring(r["html"])
         iframe = tree.xpath("//iframe")
         if len(iframe) != 1:
@@ -57,7 +47,7 @@ async def get_oembed_player(
         match = re.search(r'"(https?:\/\/[^\"]+)"', url)
 
         if url_parsed.scheme != "https":  # not match or
-            print("Non Matching URL")
+            logger.info("Non Matching URL")
             return None
 
         width = iframe.get("width", "").rstrip("%").strip('\\"')
@@ -67,7 +57,7 @@ async def get_oembed_player(
             width = int(width) if width.isdigit() else None
             height = min(int(height), 1024) if height.isdigit() else None
         except ValueError:
-            print("ValueError in width/height conversion")
+            logger.info("ValueError in width/height conversion")
             return None
 
         allowed_permissions = iframe.get("allow", "").split(";")
@@ -96,14 +86,10 @@ async def get_oembed_player(
 
 
         if non_safe_permissions:
-            print(
-                f"Non-safe permissions detected: {', '.join(non_safe_permissions)}. Skipping embed."
+            logger.info(
+                "Non-safe permissions detected: %s. Skipping embed.",
+                ", ".join(non_safe_permissions),
             )
             return None
 
-        return {
-            "url": url.rstrip("\\"),
-            "width": width,
-            "height": height,
-            "allow": allowed_permissions,
-        }
+        return Player(url.rstrip("\\"), width, height, allowed_permissions)
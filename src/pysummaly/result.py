@@ -0,0 +1,149 @@
+# summarize()とプラグインが返す要約の型
+# JSONのバイト列を一度だけ作って持ち回り、キャッシュへの保存やレスポンスではそれをそのまま使う
+from collections.abc import Iterator, Mapping
+from typing import Any
+
+import orjson
+
+
+class Player:
+    __slots__ = ("url", "width", "height", "allow")
+
+    def __init__(self, url: str | None = None, width: int | None = None, height: int | None = None, allow: list[str] | None = None):
+        self.url = url
+        self.width = width
+        self.height = height
+        self.allow = allow if allow is not None else []
+
+    @classmethod
+    def from_dict(cls, data: dict[str, Any] | None) -> "Player":
+        if not data:
+            return cls()
+        return cls(data.get("url"), data.get("width"), data.get("height"), data.get("allow"))
+
+    def to_dict(self) -> dict[str, Any]:
+        return {"url": self.url, "width": self.width, "height": self.height, "allow": self.allow}
+
+    def __repr__(self):
+        return f"Player(url={self.url!r}, width={self.width!r}, height={self.height!r}, allow={self.allow!r})"
+
+
+# (JSONのキー, 属性名)。JSONはこの順に並べる
+FIELDS = (
+    ("title", "title"),
+    ("icon", "icon"),
+    ("description", "description"),
+    ("thumbnail", "thumbnail"),
+    ("fediverseCreator", "fediverse_creator"),
+    ("activitypub", "activitypub"),
+    ("player", "player"),
+    ("sitename", "sitename"),
+    ("sensitive", "sensitive"),
+    ("url", "url"),
+)
+_ATTRS = {attr: key for key, attr in FIELDS}
+_KEYS = dict(FIELDS)
+
+
+class Summary(Mapping):
+    """ページの要約。作った後は書き換えない前提で、JSONは最初に必要になったときに1回だけ作る
+
+    キャッシュから取り出したものはJSONのバイト列だけを持ち、属性を読んだときに初めてパースする。
+    以前の辞書と同じく読み取り専用のMappingとして summary["title"]、"title" in summary、
+    summary.get()、dict(summary) が使える(playerは辞書で返す)。
+    """
+
+    __slots__ = tuple(attr for _, attr in FIELDS) + ("_json",)
+
+    def __init__(
+        self,
+        title: str,
+        icon: str | None = None,
+        description: str | None = None,
+        thumbnail: str | None = None,
+        fediverse_creator: str | None = None,
+        activitypub: str | None = None,
+        player: Player | None = None,
+        sitename: str | None = None,
+        sensitive: bool = False,
+        url: str | None = None,
+    ):
+        self.title = title
+        self.icon = icon
+        self.description = description
+        self.thumbnail = thumbnail
+        self.fediverse_creator = fediverse_creator
+        self.activitypub = activitypub
+        self.player = player if player is not None else Player()
+        self.sitename = sitename
+        self.sensitive = sensitive
+        self.url = url
+        self._json: bytes | None = None
+
+    @classmethod
+    def from_dict(cls, data: dict[str, Any]) -> "Summary":
+        # 外部のプラグインが辞書で返した場合のため。activityPubの綴りも受け付ける
+        return cls(
+            title=data.get("title"),
+            icon=data.get("icon"),
+            description=data.get("description"),
+            thumbnail=data.get("thumbnail"),
+            fediverse_creator=data.get("fediverseCreator"),
+            activitypub=data.get("activitypub", data.get("activityPub")),
+            player=data["player"] if isinstance(data.get("player"), Player) else Player.from_dict(data.get("player")),
+            sitename=data.get("sitename"),
+            sensitive=bool(data.get("sensitive", False)),
+            url=data.get("url"),
+        )
+
+    @classmethod
+    def from_json(cls, raw: bytes) -> "Summary":
+        summary = cls.__new__(cls)
+        summary._json = raw
+        return summary
+
+    def __getattr__(self, name):
+        # from_json()で作ったものは、フィールドを初めて読んだときにまとめて埋める
+        if name not in _ATTRS:
+            raise AttributeError(name)
+        data = orjson.loads(self._json)
+        for key, attr in FIELDS:
+            value = data.get(key)
+            setattr(self, attr, Player.from_dict(value) if attr == "player" else value)
+        return getattr(self, name)
+
+    @property
+    def json(self) -> bytes:
+        if self._json is None:
+            self._json = orjson.dumps(self.to_dict())
+        return self._json
+
+    def to_dict(self) -> dict[str, Any]:
+        data = {key: getattr(self, attr) for key, attr in FIELDS}
+        data["player"] = self.player.to_dict()
+        return data
+
+    def __getitem__(self, key: str):
+        if key not in _KEYS:
+            raise KeyError(key)
+        value = getattr(self, _KEYS[key])
+        return value.to_dict() if isinstance(value, Player) else value
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(_KEYS)
+
+    def __len__(self) -> int:
+        return len(_KEYS)
+
+    def __eq__(self, other):
+        if isinstance(other, Summary):
+            return self.to_dict() == other.to_dict()
+        # 以前の戻り値(辞書)との比較も通す
+        if isinstance(other, Mapping):
+            return self.to_dict() == dict(other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"Summary(title={self.title!r}, url={self.url!r})"
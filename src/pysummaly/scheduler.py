@@ -0,0 +1,122 @@
+# オリジンごとの流量制御。トークンバケットと同時実行数の上限、429/503のRetry-Afterを全リクエストで共有する
+import asyncio
+import contextvars
+import time
+from email.utils import parsedate_to_datetime
+from types import SimpleNamespace
+
+import aiohttp
+
+from . import metrics
+from .cache import TTLCache
+
+# summarize()のoperationTimeoutから決まる締め切り(loop.time()基準)。待っても間に合わないならすぐ諦める
+deadline: contextvars.ContextVar[float | None] = contextvars.ContextVar("pysummaly_deadline", default=None)
+
+BACKOFF_STATUSES = (429, 503)
+MAX_BACKOFF = 300.0
+
+
+class QueueTimeout(asyncio.TimeoutError):
+    pass
+
+
+class HostState:
+    __slots__ = ("tokens", "updated", "blocked_until", "semaphore")
+
+    def __init__(self, burst: float, concurrency: int, now: float):
+        self.tokens = burst
+        self.updated = now
+        self.blocked_until = 0.0
+        self.semaphore = asyncio.Semaphore(concurrency)
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class HostScheduler:
+    def __init__(self, rate: float | None = 10.0, burst: float = 20.0, concurrency: int = 8, maxsize: int = 10000):
+        # rate=Noneでトークンバケットを使わない(同時実行数とRetry-Afterだけ見る)
+        self.rate = rate
+        self.burst = burst
+        self.concurrency = concurrency
+        self._hosts = TTLCache(maxsize=maxsize, ttl=600)
+
+    def _state(self, host: str) -> HostState:
+        state = self._hosts.get(host)
+        if state is None:
+            state = HostState(self.burst, self.concurrency, asyncio.get_running_loop().time())
+        # 使うたびに期限を延ばす
+        self._hosts.set(host, state)
+        return state
+
+    def back_off(self, host: str, seconds: float):
+        state = self._state(host)
+        until = asyncio.get_running_loop().time() + min(seconds, MAX_BACKOFF)
+        state.blocked_until = max(state.blocked_until, until)
+
+    async def acquire(self, host: str):
+        loop = asyncio.get_running_loop()
+        state = self._state(host)
+        limit = deadline.get()
+        start = loop.time()
+        while True:
+            now = loop.time()
+            delay = max(state.blocked_until - now, 0.0)
+            if self.rate is not None:
+                state.tokens = min(self.burst, state.tokens + (now - state.updated) * self.rate)
+                state.updated = now
+                if delay == 0.0 and state.tokens < 1:
+                    delay = (1 - state.tokens) / self.rate
+            if delay == 0.0:
+                state.tokens -= 1
+                break
+            if limit is not None and now + delay > limit:
+                raise QueueTimeout(f"{host} is rate limited beyond the deadline")
+            await asyncio.sleep(delay)
+        remaining = None if limit is None else max(limit - loop.time(), 0.0)
+        try:
+            await asyncio.wait_for(state.semaphore.acquire(), remaining)
+        except asyncio.TimeoutError:
+            raise QueueTimeout(f"{host} has too many requests in flight") from None
+        metrics.observe_stage("queue", loop.time() - start)
+        return state
+
+    def trace_config(self) -> aiohttp.TraceConfig:
+        # aiohttpのトレースで全リクエスト(プラグインやHEADも含む)を通す
+        # 同時実行数はレスポンスヘッダを受け取るまでを数える。本文の読み込み中の接続数はコネクタのlimit_per_hostで抑える
+        async def on_request_start(session, context: SimpleNamespace, params: aiohttp.TraceRequestStartParams):
+            host = params.url.host or ""
+            context.scheduled = await self.acquire(host)
+
+        async def release(context: SimpleNamespace):
+            state = getattr(context, "scheduled", None)
+            if state is not None:
+                context.scheduled = None
+                state.semaphore.release()
+
+        async def on_request_end(session, context: SimpleNamespace, params: aiohttp.TraceRequestEndParams):
+            if params.response.status in BACKOFF_STATUSES:
+                retry_after = parse_retry_after(params.response.headers.get("Retry-After"))
+                if retry_after is not None:
+                    self.back_off(params.url.host or "", retry_after)
+            await release(context)
+
+        async def on_request_exception(session, context: SimpleNamespace, params: aiohttp.TraceRequestExceptionParams):
+            await release(context)
+
+        config = aiohttp.TraceConfig()
+        config.on_request_start.append(on_request_start)
+        config.on_request_end.append(on_request_end)
+        config.on_request_exception.append(on_request_exception)
+        return config
@@ -1,26 +1,79 @@
-import traceback
+import logging
+import multiprocessing
+import os
 from collections.abc import AsyncIterator
+from concurrent.futures import Executor, ProcessPoolExecutor
 from contextlib import asynccontextmanager
 from typing import Optional
 
-from fastapi import FastAPI, HTTPException, Query
-from fastapi.responses import ORJSONResponse
-from fastapi_cache import FastAPICache
-from fastapi_cache.backends.inmemory import InMemoryBackend
-from fastapi_cache.decorator import cache
-from pydantic import BaseModel
+import orjson
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
+from pydantic import BaseModel, Field
 
-from .summaly import summarize
+from . import metrics
+from .cache import MemoryBackend, RedisBackend, SQLiteBackend, SummaryCache
+from .canonical import create_canonicalizer
+from .health import HostHealth
+from .summaly import Summarizer
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_AGE = 600
+
+
+def create_cache() -> SummaryCache:
+    # 複数ノードで共有したい場合はREDIS_URL、再起動後も残したい場合はSUMMARY_DBを指定する
+    redis_url = os.environ.get("REDIS_URL")
+    db_path = os.environ.get("SUMMARY_DB")
+    if redis_url:
+        backend = RedisBackend.from_url(redis_url)
+    elif db_path:
+        max_bytes = int(os.environ.get("SUMMARY_DB_MAX_BYTES", 256 * 1024 * 1024))
+        backend = SQLiteBackend(db_path, max_bytes=max_bytes)
+    else:
+        backend = MemoryBackend()
+    return SummaryCache(backend, ttl=DEFAULT_MAX_AGE)
+
+
+def create_executor() -> Executor | None:
+    # PARSE_WORKERSを指定すると、大きなページのパースと抽出を別プロセスで行う
+    workers = int(os.environ.get("PARSE_WORKERS", "0"))
+    if workers <= 0:
+        return None
+    # スレッドが動いているプロセスをforkすると、ロックを持ったままの状態が子に写って固まることがあるので使わない
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("forkserver"))
 
 
 @asynccontextmanager
-async def lifespan(_: FastAPI) -> AsyncIterator[None]:
-    FastAPICache.init(InMemoryBackend(), prefix="fastapi-cache")
-    yield
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    executor = create_executor()
+    cache = create_cache()
+    try:
+        async with Summarizer(
+            cache=cache,
+            executor=executor,
+            canonicalizer=create_canonicalizer(),
+            health=HostHealth(hedge=os.environ.get("HEDGE_REQUESTS", "").lower() in ("1", "true", "yes")),
+        ) as summarizer:
+            app.state.summarizer = summarizer
+            yield
+    finally:
+        await cache.close()
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
 
 
 app = FastAPI(lifespan=lifespan)
 
+if os.environ.get("ENABLE_METRICS", "").lower() in ("1", "true", "yes"):
+
+    @app.get("/metrics")
+    async def metrics_endpoint():
+        return PlainTextResponse(
+            metrics.REGISTRY.render(), media_type="text/plain; version=0.0.4"
+        )
+
 
 class GeneralScrapingOptions(BaseModel):
     lang: Optional[str] = None
@@ -31,10 +84,16 @@ class GeneralScrapingOptions(BaseModel):
     contentLengthRequired: Optional[bool] = None
 
 
+class BatchRequest(BaseModel):
+    urls: list[str] = Field(max_length=100)
+    options: GeneralScrapingOptions = GeneralScrapingOptions()
+    concurrency: int = Field(8, ge=1, le=32)
+
+
 @app.get("/")
 @app.get("/url")
-@cache(expire=600)
 async def summarize_endpoint(
+    request: Request,
     url: str,
     lang: Optional[str] = Query(None),
     userAgent: Optional[str] = Query(None),
@@ -59,12 +118,54 @@ async def summarize_endpoint(
     )
 
     try:
-        metadata = await summarize(url, opts.model_dump() if opts else {})
+        metadata, max_age = await request.app.state.summarizer.summarize_with_max_age(
+            url, opts.model_dump(exclude_none=True)
+        )
         if metadata is None:
             raise HTTPException(status_code=404, detail="Metadata not found")
-        return ORJSONResponse(
-            metadata, headers={"Cache-Control": "max-age=600, public"}
+        # キャッシュに残っている新しさ(オリジンのCache-Controlに従う)をそのまま伝える
+        max_age = DEFAULT_MAX_AGE if max_age is None else int(max_age)
+        # 要約が持っているJSONのバイト列をそのまま返す(キャッシュにあったものは再エンコードしない)
+        return Response(
+            metadata.json,
+            media_type="application/json",
+            headers={"Cache-Control": f"max-age={max_age}, public"},
         )
+    except HTTPException:
+        raise
     except Exception as e:
-        print(traceback.format_exc())
+        logger.exception(
+            "summarize failed",
+            extra={"url": url, "category": metrics.error_category(e)},
+        )
         raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/batch")
+async def batch_endpoint(request: Request, body: BatchRequest):
+    summarizer = request.app.state.summarizer
+
+    async def stream():
+        async for url, metadata, error in summarizer.summarize_many(
+            body.urls,
+            body.options.model_dump(exclude_none=True),
+            concurrency=body.concurrency,
+        ):
+            if error is not None:
+                logger.warning(
+                    "batch item failed: %r",
+                    error,
+                    extra={"url": url, "category": metrics.error_category(error)},
+                )
+            # 要約のJSONはバイト列のまま埋め込む
+            yield (
+                b'{"url":'
+                + orjson.dumps(url)
+                + b',"summary":'
+                + (metadata.json if metadata is not None else b"null")
+                + b',"error":'
+                + orjson.dumps(str(error) if error is not None else None)
+                + b"}\n"
+            )
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
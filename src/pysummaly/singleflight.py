@@ -0,0 +1,44 @@
+import asyncio
+from collections.abc import Awaitable, Callable, Hashable
+from typing import Any
+
+
+class SingleFlight:
+    """同じキーで同時に走っている処理を1つにまとめ、待っている全員に同じ結果を返す"""
+
+    def __init__(self):
+        self._calls: dict[Hashable, asyncio.Task] = {}
+        self._waiters: dict[Hashable, int] = {}
+
+    def __len__(self):
+        return len(self._calls)
+
+    async def do(self, key: Hashable, fn: Callable[..., Awaitable[Any]], *args, **kwargs):
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn(*args, **kwargs))
+            self._calls[key] = task
+            self._waiters[key] = 0
+            task.add_done_callback(lambda t: self._forget(key, t))
+        self._waiters[key] += 1
+        try:
+            # 呼び出し元がキャンセルされても共有中のタスクは止めない
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if task.cancelled() or self._calls.get(key) is not task:
+                raise
+            self._waiters[key] -= 1
+            if self._waiters[key] == 0:
+                # 誰も待っていなければ無駄なので取り消す。後から来た呼び出しは新しく始める
+                del self._calls[key]
+                del self._waiters[key]
+                task.cancel()
+            raise
+
+    def _forget(self, key: Hashable, task: asyncio.Task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+            del self._waiters[key]
+        if not task.cancelled():
+            # 待ち手がいないまま失敗しても "exception was never retrieved" を出さない
+            task.exception()
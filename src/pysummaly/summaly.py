@@ -1,39 +1,89 @@
+import asyncio
+import logging
 import re
+from collections import defaultdict
+from collections.abc import AsyncIterator, Iterable
+from concurrent.futures import Executor
 from urllib.parse import urljoin, urlparse
-import ipaddress
 
 import aiohttp
+from aiohttp.abc import AbstractResolver
 
 import orjson
 from lxml import html as lxml_html
 
+from . import metrics
+from .cache import MISSING, SummaryCache, TTLCache
+from .canonical import Canonicalizer, canonicalize
+from .document import OFFLOAD_THRESHOLD, Document
+from .fetcher import NotModified, read_document
+from .fetcher import revalidation as current_validators
+from .guard import ForbiddenAddress, GuardedResolver, require_guard
+from .health import HostHealth, hedged
+from .health import current as current_health
+from .guard import trace_config as guard_trace_config
+from .scheduler import HostScheduler
+from .scheduler import deadline as request_deadline
+from .singleflight import SingleFlight
+from .result import Player, Summary
 from .plugins import check as check_fetch
+from .plugins import player as check_player
+
+logger = logging.getLogger(__name__)
+
+# operationTimeoutのうち、ページ取得後に残った時間から各サブリクエストに割り当てる割合
+ICON_BUDGET_RATIO = 0.3
+PLAYER_BUDGET_RATIO = 0.9
+
+# faviconの有無やoEmbedの結果はページごとにほぼ変わらないので、URL単位でしばらく覚えておく
+favicon_cache = TTLCache(maxsize=10000, ttl=6 * 60 * 60)
+oembed_cache = TTLCache(maxsize=10000, ttl=60 * 60)
+
+async def fetch_document(
+    session: aiohttp.ClientSession,
+    url,
+    timeout,
+    content_length_limit,
+    content_length_required,
+    head_only: bool = False,
+    conditional: bool = False,
+) -> Document:
+    # conditional=Trueならキャッシュにある検証子で条件付きリクエストにし、304ならNotModifiedを送出する
+    require_guard(session)
+    validators = current_validators.get() if conditional else None
+    headers = validators.request_headers() if validators is not None else None
+
+    async def get() -> aiohttp.ClientResponse:
+        return await session.get(url, timeout=timeout, headers=headers)
+
+    with metrics.in_flight.track(kind="fetch"):
+        # GETは冪等なので、レスポンスヘッダがホストのp95より遅れたら2本目を送ることがある。
+        # 比べる統計もヘッダまでの時間なので、本文の読み込みはヘッジに含めない
+        response = await hedged(
+            urlparse(str(url)).hostname or "", get, request_deadline.get(), discard=lambda r: r.release()
+        )
+        async with response:
+            if validators is not None:
+                validators.update(response)
+                if response.status == 304 and headers:
+                    raise NotModified(url)
+            return await read_document(response, content_length_limit, content_length_required, head_only=head_only)
 
-private_regex = r'^(10\.\d{1,3}\.\d{1,3}\.\d{1,3}$|172\.(1[6-9]|2[0-9]|3[0-1])\.\d{1,3}\.\d{1,3}$|192\.168\.\d{1,3}\.\d{1,3})'
-
-async def fetch(session: aiohttp.ClientSession, url, timeout, content_length_limit, content_length_required, cf):
-    if isinstance(cf, str):
-        return cf
-    try:
-        resolver = aiohttp.DefaultResolver()
-        infos = await resolver.resolve(url.split('://')[-1].split('/')[0], 0)
-        for info in infos:
-            ip = ipaddress.ip_address(info['host'])
-            if ip.is_private or ip.is_loopback:
-                raise Exception("Access to local IPs is denied.")
-    except Exception as e:
-        raise Exception(f"DNS resolution failed: {e}")
-    async with session.get(url, timeout=timeout) as response:
-        if content_length_required and response.content_length is None:
-            raise aiohttp.ClientPayloadError("Content length required but not provided")
-        if content_length_limit:
-            if response.content_length and response.content_length > content_length_limit:
-                raise aiohttp.ClientPayloadError("Content length exceeds limit")
-        return await response.text()
+async def fetch(session: aiohttp.ClientSession, url, timeout, content_length_limit, content_length_required):
+    doc = await fetch_document(session, url, timeout, content_length_limit, content_length_required)
+    return doc.text
 
 async def fetch_head(session, url, timeout):
-    async with session.head(url, timeout=timeout) as response:
-        return response.status == 200
+    require_guard(session)
+    ok = favicon_cache.get(url, MISSING)
+    metrics.cache_result("favicon", ok is not MISSING)
+    if ok is not MISSING:
+        return ok
+    with metrics.stage("favicon"):
+        async with session.head(url, timeout=timeout) as response:
+            ok = response.status == 200
+    favicon_cache.set(url, ok)
+    return ok
 
 def escape_html_in_json(json_string):
     try:
@@ -42,21 +92,38 @@ def escape_html_in_json(json_string):
             json_dict["html"] = json_dict["html"].replace('"', '\\"').replace("'", "\\'")
         return orjson.dumps(json_dict)
     except orjson.JSONDecodeError as e:
-        print(f"JSON decode error: {e}")
+        logger.info("JSON decode error: %s", e)
         return None
 
-async def get_oembed_player(session, page_url, timeout, content_length_limit, content_length_required):
-    cf = await check_fetch(session, page_url, timeout, content_length_limit, content_length_required)
-    if isinstance(cf, dict):
-        return cf
-    tree = await fetch_tree(session, page_url, timeout, content_length_limit, content_length_required, cf)
-    oembed_link = tree.xpath('//link[@type="application/json+oembed"]/@href')
+async def get_oembed_player(session, page_url, timeout, content_length_limit, content_length_required, doc: Document | None = None):
+    require_guard(session)
+    # プラグインが扱うURLならその結果を使う。プレイヤーが得られなかったこと(None)も覚えておく
+    player = oembed_cache.get(page_url, MISSING)
+    metrics.cache_result("plugin_player", player is not MISSING)
+    if player is MISSING:
+        player = await check_player(session, page_url, timeout, content_length_limit, content_length_required)
+        oembed_cache.set(page_url, player)
+    if player is not None:
+        return player
+    if doc is None:
+        doc = await fetch_document(session, page_url, timeout, content_length_limit, content_length_required)
+    oembed_link = doc.metadata["oembed"]
     if not oembed_link:
         return None
 
-    oembed_url = urljoin(page_url, oembed_link[0])
-    oembed_response = await fetch(session, oembed_url, timeout, content_length_limit, content_length_required, cf)
-    oembed_response = escape_html_in_json(oembed_response)
+    oembed_url = urljoin(doc.url, oembed_link)
+    player = oembed_cache.get(oembed_url, MISSING)
+    metrics.cache_result("oembed", player is not MISSING)
+    if player is MISSING:
+        with metrics.stage("oembed"):
+            player = await fetch_oembed_player(session, oembed_url, timeout, content_length_limit, content_length_required)
+        oembed_cache.set(oembed_url, player)
+    return player
+
+
+async def fetch_oembed_player(session, oembed_url, timeout, content_length_limit, content_length_required):
+    oembed_response = await fetch_document(session, oembed_url, timeout, content_length_limit, content_length_required)
+    oembed_response = escape_html_in_json(oembed_response.body)
 
     if oembed_response is None:
         return None
@@ -64,7 +131,7 @@ async def get_oembed_player(session, page_url, timeout, content_length_limit, co
     try:
         oembed_data = orjson.loads(oembed_response.decode("utf-8"))
     except orjson.JSONDecodeError as e:
-        print(f"JSON decode error: {e}")
+        logger.info("JSON decode error: %s", e)
         return None
 
     if oembed_data.get("version") != "1.0" or oembed_data.get("type") not in ["rich", "video"]:
@@ -92,7 +159,7 @@ async def get_oembed_player(session, page_url, timeout, content_length_limit, co
         width = int(width) if width.isdigit() else None
         height = min(int(height), 1024) if height.isdigit() else None
     except ValueError:
-        print("ValueError in width/height conversion")
+        logger.info("ValueError in width/height conversion")
         return None
 
     allowed_permissions = iframe.get("allow", "").split(";")
@@ -111,106 +178,271 @@ async def get_oembed_player(session, page_url, timeout, content_length_limit, co
     non_safe_permissions = [perm for perm in allowed_permissions if perm not in safe_list]
 
     if non_safe_permissions:
-        print(f"Non-safe permissions detected: {', '.join(non_safe_permissions)}. Skipping embed.")
+        logger.info("Non-safe permissions detected: %s. Skipping embed.", ", ".join(non_safe_permissions))
         return None
 
-    return {
-        "url": url.rstrip("\\"),
-        "width": width,
-        "height": height,
-        "allow": allowed_permissions,
-    }
-
-async def fetch_tree(session, url, timeout, content_length_limit, content_length_required, cf):
-    html_content = await fetch(session, url, timeout, content_length_limit, content_length_required, cf=cf)
-    return lxml_html.fromstring(html_content)
-
-async def summarize(url, opts=None):
-    opts = opts or {}
-    user_agent = opts.get("userAgent")
-    response_timeout = opts.get("responseTimeout", 10)
-    operation_timeout = opts.get("operationTimeout", 10)
-    content_length_limit = opts.get("contentLengthLimit", 100**6)
-    content_length_required = opts.get("contentLengthRequired", False)
-
-    headers = {"User-Agent": user_agent} if user_agent else {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36 PySummalyBot/x.y.z"}
-    timeout = aiohttp.ClientTimeout(total=operation_timeout, connect=response_timeout)
-
-    if bool(re.match(private_regex, urlparse(url).hostname)): 
-        return {}
-    async with aiohttp.ClientSession(headers=headers, timeout=timeout) as session:
-        cf = await check_fetch(session, url, timeout, content_length_limit, content_length_required, no_oembed=True)
-        if isinstance(cf, dict):
-            return cf
-        tree = await fetch_tree(session, url, timeout, content_length_limit, content_length_required, cf=cf)
-
-        title = (
-            tree.xpath('//meta[@property="og:title"]/@content')
-            or tree.xpath('//meta[@name="twitter:title"]/@content')
-            or tree.xpath("//title/text()")
+    return Player(url.rstrip("\\"), width, height, allowed_permissions)
+
+async def fetch_tree(session, url, timeout, content_length_limit, content_length_required):
+    doc = await fetch_document(session, url, timeout, content_length_limit, content_length_required)
+    return doc.tree
+
+DEFAULT_USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36 PySummalyBot/x.y.z"
+
+
+class Summarizer:
+    def __init__(
+        self,
+        limit: int = 100,
+        limit_per_host: int = 8,
+        keepalive_timeout: float = 30,
+        ttl_dns_cache: int = 300,
+        cache: SummaryCache | None = None,
+        resolver: AbstractResolver | None = None,
+        allow_networks=(),
+        scheduler: HostScheduler | None = None,
+        executor: Executor | None = None,
+        offload_threshold: int = OFFLOAD_THRESHOLD,
+        canonicalizer: Canonicalizer | None = None,
+        health: HostHealth | None = None,
+    ):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.ttl_dns_cache = ttl_dns_cache
+        self.resolver = resolver
+        self.allow_networks = tuple(allow_networks)
+        self._connector: aiohttp.TCPConnector | None = None
+        self._guard: GuardedResolver | None = None
+        self.scheduler = scheduler if scheduler is not None else HostScheduler(concurrency=limit_per_host)
+        self.health = health if health is not None else HostHealth()
+        self._trace_configs = [
+            guard_trace_config(self.allow_networks),
+            # ブレーカーで止めるリクエストはスケジューラの枠を使わない
+            self.health.trace_config(),
+            self.scheduler.trace_config(),
+            metrics.trace_config(),
+        ]
+        self.cache = cache
+        # 大きなページのパースと抽出を任せるプール。作成・終了は呼び出し側が持つ
+        self.executor = executor
+        self.offload_threshold = offload_threshold
+        self.canonicalize = canonicalizer if canonicalizer is not None else canonicalize
+        self._flights = SingleFlight()
+
+    @property
+    def connector(self) -> aiohttp.TCPConnector:
+        if self._connector is None or self._connector.closed:
+            if self._guard is None:
+                self._guard = GuardedResolver(self.resolver, ttl=self.ttl_dns_cache, allow_networks=self.allow_networks)
+            self._connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                # 名前解決のキャッシュと接続先の検証はGuardedResolverが持つ
+                resolver=self._guard,
+                use_dns_cache=False,
+            )
+        return self._connector
+
+    def session(self, headers=None, timeout=None) -> aiohttp.ClientSession:
+        # User-Agentやタイムアウトはリクエストごとに違うので、セッションは都度作ってコネクタだけ共有する
+        return aiohttp.ClientSession(
+            connector=self.connector,
+            connector_owner=False,
+            headers=headers,
+            timeout=timeout,
+            trace_configs=self._trace_configs,
         )
-        title = title[0] if title else None
 
-        if not title:
-            return None
-
-        image = (
-            tree.xpath('//meta[@property="og:image"]/@content')
-            or tree.xpath('//meta[@name="twitter:image"]/@content')
-            or tree.xpath('//link[@rel="image_src"]/@href')
-            or tree.xpath('//link[@rel="apple-touch-icon"]/@href')
-        )
-        image = image[0] if image else None
-        image = urljoin(url, image) if image else None
-
-        description = (
-            tree.xpath('//meta[@property="og:description"]/@content')
-            or tree.xpath('//meta[@name="twitter:description"]/@content')
-            or tree.xpath('//meta[@name="description"]/@content')
-        )
-        description = description[0] if description else None
-
-        site_name = (
-            tree.xpath('//meta[@property="og:site_name"]/@content')
-            or tree.xpath('//meta[@name="application-name"]/@content')
-        )
-        site_name = site_name[0] if site_name else urlparse(url).hostname
+    async def close(self):
+        if self._connector is not None:
+            await self._connector.close()
+            self._connector = None
+        # TCPConnectorは渡されたリゾルバを閉じないので、ここで閉じる
+        if self._guard is not None:
+            await self._guard.close()
+            self._guard = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def summarize(self, url, opts=None):
+        summary, _ = await self.summarize_with_max_age(url, opts)
+        return summary
+
+    async def summarize_with_max_age(self, url, opts=None) -> tuple[Summary | None, float | None]:
+        # 結果と、それがあと何秒新しいとみなせるか(キャッシュがなければNone)を返す
+        opts = opts or {}
+        # 同じページを指すURLは正規化したものを取りに行き、キャッシュや同時リクエストの集約もそれで行う
+        url = self.canonicalize(url)
+        key = request_key(url, opts, canonicalizer=None)
+        return await self._flights.do(key, self._cached_summarize, key, url, opts)
+
+    async def summarize_many(
+        self,
+        urls: Iterable[str],
+        opts=None,
+        concurrency: int = 16,
+        per_host: int = 4,
+    ) -> AsyncIterator[tuple[str, Summary | None, Exception | None]]:
+        # 終わった順に (url, 結果, 例外) を返す。同じホストへの同時実行数はper_hostまで
+        limit = asyncio.Semaphore(concurrency)
+        host_limits = defaultdict(lambda: asyncio.Semaphore(per_host))
+
+        async def run(url):
+            try:
+                async with host_limits[urlparse(url).hostname], limit:
+                    return url, await self.summarize(url, opts), None
+            except Exception as e:
+                return url, None, e
+
+        tasks = [asyncio.ensure_future(run(url)) for url in urls]
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield await task
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _cached_summarize(self, key, url, opts):
+        if self.cache is None:
+            return await self._summarize(url, opts), None
+        return await self.cache.get_or_fetch_with_max_age(key, lambda: self._summarize(url, opts))
+
+    async def _summarize(self, url, opts):
+        user_agent = opts.get("userAgent")
+        response_timeout = opts.get("responseTimeout", 10)
+        operation_timeout = opts.get("operationTimeout", 10)
+        content_length_limit = opts.get("contentLengthLimit", 100**6)
+        content_length_required = opts.get("contentLengthRequired", False)
+
+        headers = {"User-Agent": user_agent or DEFAULT_USER_AGENT}
+        timeout = aiohttp.ClientTimeout(total=operation_timeout, connect=response_timeout)
+
+        current_health.set(self.health)
+        with metrics.in_flight.track(kind="summarize"), metrics.stage("summarize"):
+            try:
+                async with self.session(headers=headers, timeout=timeout) as session:
+                    return await summarize_with_session(
+                        session,
+                        url,
+                        timeout,
+                        content_length_limit,
+                        content_length_required,
+                        executor=self.executor,
+                        offload_threshold=self.offload_threshold,
+                    )
+            except NotModified:
+                raise
+            except Exception as e:
+                metrics.errors.inc(category=metrics.error_category(e))
+                raise
+
+
+# 結果を変えるオプション。langなどここにないものはキーに含めず、同じページを1つのエントリにまとめる
+KEY_OPTIONS = frozenset(
+    {"userAgent", "responseTimeout", "operationTimeout", "contentLengthLimit", "contentLengthRequired"}
+)
+
+
+def request_key(url, opts=None, canonicalizer: Canonicalizer | None = canonicalize) -> str:
+    # 正規化済みのURLを渡す場合はcanonicalizer=None
+    normalized = canonicalizer(url) if canonicalizer is not None else url
+    options = sorted((k, v) for k, v in (opts or {}).items() if k in KEY_OPTIONS and v is not None)
+    return orjson.dumps([normalized, options]).decode()
+
+
+async def summarize(url, opts=None, cache: SummaryCache | None = None):
+    async with Summarizer(cache=cache) as summarizer:
+        return await summarizer.summarize(url, opts)
+
+
+async def summarize_many(
+    urls: Iterable[str],
+    opts=None,
+    concurrency: int = 16,
+    per_host: int = 4,
+    cache: SummaryCache | None = None,
+):
+    async with Summarizer(cache=cache) as summarizer:
+        async for item in summarizer.summarize_many(urls, opts, concurrency=concurrency, per_host=per_host):
+            yield item
+
+
+async def with_budget(coro, budget, default=None, errors=()):
+    try:
+        return await asyncio.wait_for(coro, budget)
+    except (asyncio.TimeoutError, *errors):
+        return default
+
+
+async def summarize_with_session(
+    session: aiohttp.ClientSession,
+    url,
+    timeout,
+    content_length_limit,
+    content_length_required,
+    executor: Executor | None = None,
+    offload_threshold: int = OFFLOAD_THRESHOLD,
+):
+    # プラグインもこのセッションで取得するので、最初に検証が入っているかを確かめる
+    require_guard(session)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout.total if timeout.total else None
+    request_deadline.set(deadline)
+    cf = await check_fetch(session, url, timeout, content_length_limit, content_length_required)
+    if isinstance(cf, Summary):
+        return cf
+    if isinstance(cf, dict):
+        return Summary.from_dict(cf)
+    doc = cf if isinstance(cf, Document) else await fetch_document(
+        session, url, timeout, content_length_limit, content_length_required, head_only=True, conditional=True
+    )
+    metadata = await doc.load_metadata(executor, offload_threshold)
+
+    title = metadata["title"]
+    if not title:
+        return None
 
-        favicon = (
-            tree.xpath('//link[@rel="shortcut icon"]/@href')
-            or tree.xpath('//link[@rel="icon"]/@href')
-        )
-        favicon = favicon[0] if favicon else "/favicon.ico"
-        favicon = urljoin(url, favicon)
-
-        activity_pub = tree.xpath('//link[@rel="alternate"][@type="application/activity+json"]/@href')
-        activity_pub = activity_pub[0] if activity_pub else None
-
-        mixi_sensitive = tree.xpath('//meta[@property="mixi:content-rating"]/@content')
-        mixi_sensitive = mixi_sensitive[0] == "1" if mixi_sensitive else False
-        sensitive = tree.xpath('//meta[@name="rating"]/@content')
-        sensitive = sensitive[0] == "adult" or sensitive[0] == "RTA-5042-1996-1400-1577-RTA" if sensitive else False
-        sensitive = mixi_sensitive or sensitive
-        
-        fediverse_creator = tree.xpath('//meta[@name="fediverse:creator"]/@content')
-        fediverse_creator = fediverse_creator[0] if fediverse_creator else None
-
-        icon_url = await fetch_head(session, favicon, timeout)
-        icon = favicon if icon_url else None
-
-        oembed = await get_oembed_player(session, url, timeout, content_length_limit, content_length_required)
-        if oembed is None:
-            oembed = {"url": None, "width": None, "height": None}
-
-        return {
-            "title": title,
-            "icon": icon,
-            "description": description,
-            "thumbnail": image,
-            "fediverseCreator": fediverse_creator,
-            "activitypub": activity_pub,
-            "player": oembed,
-            "sitename": site_name,
-            "sensitive": sensitive,
-            "url": url,
-        }
\ No newline at end of file
+    image = metadata["image"]
+    image = urljoin(doc.url, image) if image else None
+
+    site_name = metadata["sitename"] or urlparse(url).hostname
+
+    favicon = metadata["favicon"] or "/favicon.ico"
+    favicon = urljoin(doc.url, favicon)
+
+    # faviconとoEmbedは互いに依存しないので並行して取りに行く
+    remaining = max(deadline - loop.time(), 0) if deadline is not None else None
+    icon_url, oembed = await asyncio.gather(
+        with_budget(
+            fetch_head(session, favicon, timeout),
+            remaining * ICON_BUDGET_RATIO if remaining is not None else None,
+            default=False,
+            errors=(aiohttp.ClientError, ForbiddenAddress),
+        ),
+        # oEmbedの取得に失敗しても、ページ自体の要約はplayerなしで返す
+        with_budget(
+            get_oembed_player(session, url, timeout, content_length_limit, content_length_required, doc=doc),
+            remaining * PLAYER_BUDGET_RATIO if remaining is not None else None,
+            errors=(aiohttp.ClientError, ForbiddenAddress),
+        ),
+    )
+    icon = favicon if icon_url else None
+
+    return Summary(
+        title=title,
+        icon=icon,
+        description=metadata["description"],
+        thumbnail=image,
+        fediverse_creator=metadata["fediverseCreator"],
+        activitypub=metadata["activitypub"],
+        player=oembed,
+        sitename=site_name,
+        sensitive=metadata["sensitive"],
+        url=url,
+    )
\ No newline at end of file
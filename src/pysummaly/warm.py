@@ -0,0 +1,83 @@
+# URLの一覧を要約して永続キャッシュ(SQLite)に入れておく。デプロイ前に実行すると再起動直後の取得が集中しない
+#   pysummaly-warm --db summaries.db urls.txt
+#   cat urls.txt | python -m pysummaly.warm --db summaries.db -
+import argparse
+import asyncio
+import logging
+import sys
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def read_urls(path: str) -> list[str]:
+    stream = sys.stdin if path == "-" else open(path, encoding="utf-8")
+    with stream:
+        urls = (line.strip() for line in stream)
+        # 重複と空行・#で始まる行は除く
+        return list(dict.fromkeys(url for url in urls if url and not url.startswith("#")))
+
+
+async def warm(
+    urls: list[str],
+    db: str,
+    max_bytes: int,
+    ttl: float,
+    concurrency: int,
+    per_host: int,
+    opts: dict | None = None,
+) -> tuple[int, int]:
+    # aiohttpなどの読み込みは引数を確認してからにする
+    from .cache import SQLiteBackend, SummaryCache
+    from .canonical import create_canonicalizer
+    from .summaly import Summarizer
+
+    cache = SummaryCache(SQLiteBackend(db, max_bytes=max_bytes), ttl=ttl)
+    ok = failed = 0
+    start = time.perf_counter()
+    try:
+        # サーバーと同じ正規化とオプションでキーを作らないと、入れたエントリが読まれない
+        async with Summarizer(cache=cache, canonicalizer=create_canonicalizer()) as summarizer:
+            async for url, _, error in summarizer.summarize_many(
+                urls, opts, concurrency=concurrency, per_host=per_host
+            ):
+                if error is None:
+                    ok += 1
+                else:
+                    failed += 1
+                    logger.warning("failed to summarize %s: %r", url, error)
+                done = ok + failed
+                if done % 100 == 0 or done == len(urls):
+                    logger.info("%d/%d done (%.1f s)", done, len(urls), time.perf_counter() - start)
+    finally:
+        await cache.close()
+    return ok, failed
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Pre-warm the persistent summary store from a list of URLs")
+    parser.add_argument("urls", help="file with one URL per line, or - for stdin")
+    parser.add_argument("--db", required=True, help="path to the SQLite store (same as SUMMARY_DB)")
+    parser.add_argument("--max-bytes", type=int, default=256 * 1024 * 1024)
+    parser.add_argument("--ttl", type=float, default=600, help="seconds to keep summaries without Cache-Control")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--per-host", type=int, default=4)
+    # サーバーへのリクエストで指定されるのと同じ値を渡す(キャッシュのキーに含まれる)
+    parser.add_argument("--user-agent", dest="userAgent", metavar="UA")
+    parser.add_argument("--response-timeout", dest="responseTimeout", type=int, metavar="SECONDS")
+    parser.add_argument("--operation-timeout", dest="operationTimeout", type=int, metavar="SECONDS")
+    parser.add_argument("--content-length-limit", dest="contentLengthLimit", type=int, metavar="BYTES")
+    parser.add_argument("--content-length-required", dest="contentLengthRequired", action="store_true", default=None)
+    args = parser.parse_args(argv)
+    names = ("userAgent", "responseTimeout", "operationTimeout", "contentLengthLimit", "contentLengthRequired")
+    opts = {name: getattr(args, name) for name in names if getattr(args, name) is not None}
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    urls = read_urls(args.urls)
+    ok, failed = asyncio.run(warm(urls, args.db, args.max_bytes, args.ttl, args.concurrency, args.per_host, opts))
+    logger.info("warmed %d summaries, %d failed", ok, failed)
+    return 1 if failed and not ok else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())